@@ -2,90 +2,460 @@
 # -*- coding: utf-8 -*-
 # Author: Stian Rødven Eide
 
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
 import re
 import os
-import bz2
 import argparse
+import collections
+import hashlib
+import multiprocessing
+import time
+import bz2blocks
 import contract
+import korp
+import korpindex
+import postprocess
+import sinks
 
 
-def extract_bw(sentence):
-    '''This function takes an XML sentence as input and returns either a list
-    of the words themselves (if plain mode is used) or a list of either the
-    lemma, saldo or lex attributes, depending on mode. If any of the latter,
-    only the first attribute is used for any given word, and if missing, it
-    is substituted by the word.'''
+def extract_bw(sentence, mode):
+    '''This function takes a sentence from korp.KorpReader as input and
+    returns either a list of the words themselves (if plain mode is used) or
+    a list of either the lemma, saldo or lex attributes, depending on mode.
+    If any of the latter, only the first attribute is used for any given
+    word, and if missing, it is substituted by the word.'''
     if mode == 'lemma':
         sep = ' '
     else:
         sep = '_'
     sentlist = []
-    for w in sentence:
+    for word, value in zip(sentence.words, sentence.values):
         if mode == 'plain':
-            if w.text:
-                sentlist.append(w.text)
+            if word:
+                sentlist.append(word)
             else:
                 sentlist.append('noword')
         else:
-            lexes = [l for l in w.attrib[mode].split('|')
+            lexes = [l for l in value.split('|')
                      if (l and not sep in l)]
             if lexes:
                 sentlist.append('|'.join(lexes))
-            elif w.text:
-                sentlist.append(w.text)
+            elif word:
+                sentlist.append(word)
             else:
                 sentlist.append('noword')
     return sentlist
 
 
-def process_dir(directory):
-    '''This function traverses a directory and processes any bzipped
-    xml files it finds. If the MWE option is used, it calls the check_mwe
-    function in contract.py for each sentence element. If the MWE option is
-    not used, the extract_bw function above is called instead.
-
-    For each sentence, a string is written to outfile, formatted depending on
-    whether plain, lemma, saldo or lex mode is used.'''
-    global mode
-    global mwe
-    global genre
-    global outfile
-    global first
+def contract_sentence(sentence, mode):
+    '''Contracts the MWEs of a sentence from korp.KorpReader, like
+    contract.check_mwe does for an XML sentence. Returns None if the
+    sentence has other elements than <w>.'''
+    if any(tag != 'w' for tag in sentence.tags):
+        return None
+    return contract.contract_words(sentence.words, sentence.values, mode)
+
+
+def sentence_pairs(sentence):
+    '''Returns a sentence from korp.KorpReader as a tuple of (word,
+    attribute) pairs for contract_batch, or None if contract_sentence
+    would reject it.'''
+    if any(tag != 'w' for tag in sentence.tags):
+        return None
+    return tuple(zip(sentence.words, sentence.values))
+
+
+def contract_batch(task):
+    '''Worker function for MWEPool. Contracts a batch of sentences given by
+    sentence_pairs. Returns the results with the id of the process and the
+    number of hits and misses of its check_mwe cache so far.'''
+    mode, batch = task
+    results = []
+    for pairs in batch:
+        if pairs == None:
+            results.append(None)
+        else:
+            results.append(contract.contract_words([w for w, _ in pairs],
+                                                   [v for _, v in pairs],
+                                                   mode))
+    hits, misses, _ = contract.cache_info()
+    return results, os.getpid(), hits, misses
+
+
+class MWEPool(object):
+    '''A pool of worker processes that contracts the MWEs of sentences, for
+    the --mwe option with --mwe-workers. The parser turns each sentence
+    into plain tuples, which are cheap to send, and sends them in batches
+    of batch_size. At most twice as many batches as there are workers are
+    in flight at a time, so the parser waits for the workers instead of
+    reading ahead, and the results come back in the order of the
+    sentences.'''
+
+    def __init__(self, workers, batch_size, mode):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.mode = mode
+        self.pool = multiprocessing.Pool(workers)
+        # The cache statistics of each worker process
+        self.caches = {}
+
+    def contract(self, sentences):
+        '''Yields the contracted form of each sentence, as
+        contract_sentence would return it.'''
+        pending = collections.deque()
+        batch = []
+        for sentence in sentences:
+            batch.append(sentence_pairs(sentence))
+            if len(batch) == self.batch_size:
+                pending.append(self.pool.apply_async(contract_batch,
+                                                     ((self.mode, batch),)))
+                batch = []
+                if len(pending) >= 2 * self.workers:
+                    for sent in self.results(pending.popleft()):
+                        yield sent
+        if batch:
+            pending.append(self.pool.apply_async(contract_batch,
+                                                 ((self.mode, batch),)))
+        while pending:
+            for sent in self.results(pending.popleft()):
+                yield sent
+
+    def results(self, result):
+        results, pid, hits, misses = result.get()
+        self.caches[pid] = (hits, misses)
+        return results
+
+    def cache_info(self):
+        '''Returns the hits, misses and hit rate of the caches of all
+        workers together, like contract.cache_info.'''
+        hits = sum(h for h, _ in self.caches.values())
+        misses = sum(m for _, m in self.caches.values())
+        total = hits + misses
+        return hits, misses, hits / total if total else 0.0
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type:
+            self.pool.terminate()
+        else:
+            self.close()
+
+
+def find_xmldocs(directory):
+    '''Returns the paths of all bzipped xml files below directory, in a
+    fixed order so that output from several runs can be merged the same
+    way.'''
+    xmldocs = []
     for root, dirs, files in os.walk(directory):
-        os.chdir(root)
-        folder_content = os.listdir(root)
-        xmldocs = [f for f in folder_content if f.endswith('.xml.bz2')]
-        if xmldocs:
-            for doc in xmldocs:
-                print("Processing {dir}/{file}".format(dir=root,file=doc))
-                infile = bz2.BZ2File(doc, 'rb')
-                xmldata = ET.iterparse(infile, events=['start', 'end'])
-                _, xroot = next(xmldata)
-                for event, element in xmldata:
-                    if genre != 'all':
-                        if element.tag == 'text' and event == 'start':
-                            if 'genre' in element.attrib:
-                                if element.attrib['genre'] != genre:
-                                    continue
-                    if element.tag == 'sentence' and event == 'end':
-                        if mwe:
-                            sent = contract.check_mwe(element, mode)
-                        else:
-                            sent = extract_bw(element)
-                        if sent == None:
-                            continue
-                        if first:
-                            sent = [s.split('|')[0] for s in sent if s]
-                        else:
-                            sent = [s for s in sent if s]
-                        outstring = ' '.join(sent)
-                        with open(outfile, "a+") as f:
-                            f.write(outstring + '\n')
-                    xroot.clear()
+        dirs.sort()
+        for f in sorted(files):
+            if f.endswith('.xml.bz2'):
+                xmldocs.append(os.path.join(root, f))
+    return xmldocs
+
+
+def process_file(doc, out, options, stats=None, mwe_pool=None):
+    '''This function processes a single bzipped xml file, reading it one
+    sentence at a time with korp.KorpReader. The file is decompressed as
+    set by the --decompress-workers option, see bz2blocks.open_bz2, and if
+    stats is given, the time spent in each stage is added to it.
+
+    Texts that do not match the --genre, --year and --filter options are
+    skipped without building their sentences. With --index, and an index
+    written by korpindex.py, they are not even decompressed. Each remaining
+    sentence is written to out, an open file or Sink, by write_sentence,
+    or, if an MWEPool is given, contracted by the pool and written in
+    order. Returns the number of texts, of skipped texts and of skipped
+    sentences.'''
+    attribute = None if options.mode == 'plain' else options.mode
+    accept_text = korp.text_filter(text_conditions(options))
+    normalize = None
+    if options.normalize:
+        normalize = postprocess.from_options(options)
+    index = None
+    if options.index and accept_text:
+        index = korpindex.load_index(doc)
+        if index == None:
+            print("No up-to-date index for {file}".format(file=doc))
+    if index:
+        texts = index.select(accept_text)
+        infile = bz2blocks.PipelineReader(
+            index.iter_xml(texts, options.decompress_workers, stats), stats)
+    else:
+        infile = bz2blocks.open_bz2(doc, options.decompress_workers, stats)
+    with infile:
+        reader = korp.KorpReader(infile, attribute, accept_text=accept_text)
+        sentences = reader
+        if stats:
+            sentences = stats.timed(sentences, 'parse')
+        if mwe_pool:
+            for sent in mwe_pool.contract(sentences):
+                write_words(sent, out, options, normalize)
+        else:
+            for sentence in sentences:
+                write_sentence(sentence, out, options, normalize)
+    if index:
+        # The reader only saw the selected texts, so the skipped ones are
+        # counted from the index, as those the filter rejects like above
+        skipped = [text for text in index.texts
+                   if not accept_text(text.attrs)]
+        return (len(index.texts), len(skipped),
+                sum(text.sentences for text in skipped))
+    return reader.texts, reader.skipped_texts, reader.skipped_sentences
+
+
+def write_sentence(sentence, out, options, normalize=None):
+    '''Writes a single sentence from korp.KorpReader to out. If the MWE
+    option is used, the MWEs of the sentence are contracted with
+    contract_sentence above. If the MWE option is not used, the extract_bw
+    function above is called instead. The string written is formatted
+    depending on whether plain, lemma, saldo or lex mode is used.
+
+    If normalize, a postprocess.Normalizer, is given, the string is
+    normalized the same way as by postprocess.py before it is written, and
+    sentences without tokens left are not written.'''
+    if options.mwe:
+        sent = contract_sentence(sentence, options.mode)
+    else:
+        sent = extract_bw(sentence, options.mode)
+    write_words(sent, out, options, normalize)
+
+
+def write_words(sent, out, options, normalize=None):
+    '''Writes the words of a sentence, as returned by contract_sentence or
+    extract_bw, as described for write_sentence. Nothing is written if sent
+    is None.'''
+    if sent == None:
+        return
+    if options.first_only:
+        sent = [s.split('|')[0] for s in sent if s]
+    else:
+        sent = [s for s in sent if s]
+    outstring = ' '.join(sent)
+    if normalize:
+        outstring = normalize.line(outstring)
+        if outstring == None:
+            return
+    out.write(outstring + '\n')
+
+
+def text_conditions(options):
+    '''Returns the conditions on <text> attributes given by the --genre,
+    --year and --filter options, as a dictionary from attribute names to
+    sets of accepted values for korp.text_filter.'''
+    conditions = {}
+    if 'all' not in options.genre:
+        conditions['genre'] = set(options.genre)
+    if options.year:
+        conditions['year'] = set(options.year)
+    for name, value in options.filter or []:
+        conditions.setdefault(name, set()).add(value)
+    return conditions
+
+
+GENRES = ['fiction', 'government', 'news', 'science', 'socialmedia', 'all']
+
+
+def genre_list(text):
+    '''Parses a comma-separated list of genres, e.g. news,fiction.'''
+    genres = text.split(',')
+    for genre in genres:
+        if genre not in GENRES:
+            raise argparse.ArgumentTypeError(
+                "invalid genre: %s (choose from %s)" % (genre,
+                                                        ', '.join(GENRES)))
+    return genres
+
+
+def year_list(text):
+    '''Parses a comma-separated list of years and ranges of years, e.g.
+    2001-2005,2010, into a list of years as strings.'''
+    years = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "not a year or range of years: %s" % part)
+        years.extend(str(year) for year in range(first, last + 1))
+    return years
+
+
+def attribute_value(text):
+    '''Parses a condition of the form ATTRIBUTE=VALUE.'''
+    name, sep, value = text.partition('=')
+    if not (name and sep):
+        raise argparse.ArgumentTypeError("expected ATTRIBUTE=VALUE: %s"
+                                         % text)
+    return name, value
+
+
+def process_dir(directory, outfile, options):
+    '''This function traverses a directory and processes any bzipped
+    xml files it finds, one after another, appending the sentences to
+    outfile through a single buffered Sink. With --mwe and --mwe-workers
+    above 1, the MWEs are contracted by an MWEPool shared by all files.'''
+    stats = bz2blocks.PipelineStats() if options.stats else None
+    started = time.perf_counter()
+    mwe_pool = None
+    if options.mwe and options.mwe_workers > 1:
+        mwe_pool = MWEPool(options.mwe_workers, options.batch_size,
+                           options.mode)
+    with sinks.open_sink(outfile, options) as out:
+        if mwe_pool:
+            with mwe_pool:
+                counts = process_docs(directory, out, options, stats,
+                                      mwe_pool)
+        else:
+            counts = process_docs(directory, out, options, stats)
+    if mwe_pool:
+        print_cache_info(mwe_pool.cache_info())
+    elif options.mwe:
+        print_cache_info()
+    if text_conditions(options):
+        print_filter_info(*counts)
+    if stats:
+        print_stats(stats, time.perf_counter() - started)
+
+
+def process_docs(directory, out, options, stats=None, mwe_pool=None):
+    '''Processes the files below directory with process_file, one after
+    another, and returns the sums of their counts.'''
+    counts = [0, 0, 0]
+    for doc in find_xmldocs(directory):
+        print("Processing {file}".format(file=doc))
+        file_counts = process_file(doc, out, options, stats, mwe_pool)
+        counts = [a + b for a, b in zip(counts, file_counts)]
+    return counts
+
+
+def print_cache_info(info=None):
+    '''Prints how often check_mwe found a sentence in its cache, or the
+    given hits, misses and hit rate.'''
+    hits, misses, rate = info or contract.cache_info()
+    print("MWE cache: {hits} hits, {misses} misses, hit rate {rate:.1%}"
+          .format(hits=hits, misses=misses, rate=rate))
+
+
+def print_filter_info(texts, skipped_texts, skipped_sentences):
+    '''Prints how many texts and sentences the text filter skipped.'''
+    print("Skipped {skipped} of {texts} texts ({sentences} sentences)"
+          .format(skipped=skipped_texts, texts=texts,
+                  sentences=skipped_sentences))
+
+
+def print_stats(stats, wall):
+    '''Prints the throughput of each stage of the extraction.'''
+    for line in stats.report(wall):
+        print(line)
+
+
+def extract_to_shard(task):
+    '''Worker function for process_dir_parallel. Processes one file into
+    its own shard, which is only renamed into place once it is complete.'''
+    doc, shard, options = task
+    stats = bz2blocks.PipelineStats() if options.stats else None
+    started = time.perf_counter()
+    with sinks.Sink(shard + '.part', mode='w',
+                    buffer_size=options.buffer_size) as out:
+        counts = process_file(doc, out, options, stats)
+    os.replace(shard + '.part', shard)
+    if options.mwe:
+        print_cache_info()
+    if text_conditions(options):
+        print_filter_info(*counts)
+    if stats:
+        print_stats(stats, time.perf_counter() - started)
+    return doc
+
+
+def read_manifest(manifest):
+    '''Returns the sets of files that are done (have a complete shard) and
+    merged (have been appended to outfile) according to the manifest, and
+    the size outfile had before the last shard that was being merged when
+    the run was interrupted, or None.'''
+    done = set()
+    merged = set()
+    merging = None
+    if os.path.exists(manifest):
+        with open(manifest, encoding='utf-8') as f:
+            for line in f:
+                state, _, doc = line.rstrip('\n').partition('\t')
+                if state == 'done':
+                    done.add(doc)
+                elif state == 'merging':
+                    size, _, doc = doc.partition('\t')
+                    merging = int(size)
+                elif state == 'merged':
+                    merged.add(doc)
+                    merging = None
+    return done, merged, merging
+
+
+def shard_name(doc):
+    '''Returns the name of the shard of a file, which only depends on its
+    path, so that files added or removed between runs do not change the
+    shards of the others.'''
+    return hashlib.sha1(doc.encode('utf-8')).hexdigest() + '.txt'
+
+
+def process_dir_parallel(directory, outfile, options, workers):
+    '''This function processes the bzipped xml files below directory with a
+    pool of worker processes, one file per worker at a time. Each file is
+    written to its own shard in outfile.shards, and the shards are appended
+    to outfile in the order of find_xmldocs once all files are done, so the
+    result does not depend on the number of workers.
+
+    Progress is recorded in outfile.manifest. If a run is interrupted,
+    running the same command again skips the files that are already done
+    and the shards that are already merged. The size of outfile is recorded
+    before each shard is appended, and a shard that was only partly
+    appended is cut off again before it is merged anew.'''
+    shard_dir = outfile + '.shards'
+    manifest = outfile + '.manifest'
+    os.makedirs(shard_dir, exist_ok=True)
+    xmldocs = find_xmldocs(directory)
+    shards = {doc: os.path.join(shard_dir, shard_name(doc))
+              for doc in xmldocs}
+    done, merged, merging = read_manifest(manifest)
+    todo = [(doc, shards[doc], options) for doc in xmldocs
+            if doc not in merged and not (doc in done
+                                          and os.path.exists(shards[doc]))]
+    print("{todo} of {total} files to process".format(todo=len(todo),
+                                                       total=len(xmldocs)))
+    with open(manifest, 'a', encoding='utf-8') as log:
+        with multiprocessing.Pool(workers) as pool:
+            for doc in pool.imap_unordered(extract_to_shard, todo):
+                print("Processed {file}".format(file=doc))
+                log.write('done\t' + doc + '\n')
+                log.flush()
+        if merging != None:
+            with open(outfile, 'r+b') as out:
+                out.truncate(merging)
+        for doc in xmldocs:
+            if doc in merged:
+                continue
+            size = os.path.getsize(outfile) if os.path.exists(outfile) else 0
+            log.write('merging\t{size}\t{doc}\n'.format(size=size, doc=doc))
+            log.flush()
+            # Each shard is written through a sink of its own, so that a
+            # compressed outfile ends in a complete stream after each one
+            with sinks.open_sink(outfile, options) as out:
+                with open(shards[doc]) as shard:
+                    for line in shard:
+                        out.write(line)
+            log.write('merged\t' + doc + '\n')
+            log.flush()
+            os.remove(shards[doc])
+    os.remove(manifest)
+    os.rmdir(shard_dir)
 
 
 if __name__ == '__main__':
@@ -95,20 +465,68 @@ if __name__ == '__main__':
                         default="plain")
     parser.add_argument('--mwe', action="store_true", default=False)
     parser.add_argument('--first-only', action="store_true", default=False)
-    parser.add_argument('--genre', choices=['fiction', 'government', 'news',
-                        'science', 'socialmedia', 'all'], default="all")
+    parser.add_argument('--genre', type=genre_list, default=['all'],
+                        help="only extract texts of these genres, separated "
+                        "by commas: " + ', '.join(GENRES))
+    parser.add_argument('--year', type=year_list,
+                        help="only extract texts from these years, e.g. "
+                        "2005 or 2001-2003,2005")
+    parser.add_argument('--filter', type=attribute_value, action='append',
+                        metavar='ATTRIBUTE=VALUE',
+                        help="only extract texts with this value of a text "
+                        "attribute, e.g. source=gp; may be repeated")
+    parser.add_argument('--index', action="store_true", default=False,
+                        help="with the options above, only decompress the "
+                        "texts that match, using the indexes written by "
+                        "korpindex.py")
+    parser.add_argument('--normalize', action="store_true", default=False,
+                        help="normalize the sentences like postprocess.py "
+                        "before writing them, using the options below")
+    postprocess.add_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="process this many files in parallel, writing "
+                        "resumable per-file shards that are merged at the end")
+    parser.add_argument('--decompress-workers', type=int, default=0,
+                        help="decompress each file in a background thread "
+                        "(1) or split it into bz2 blocks that are "
+                        "decompressed by this many processes (2 or more)")
+    parser.add_argument('--mwe-workers', type=int, default=1,
+                        help="with --mwe, contract the MWEs of each file in "
+                        "this many processes while it is parsed")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="number of sentences sent to an MWE worker at "
+                        "a time")
+    parser.add_argument('--stats', action="store_true", default=False,
+                        help="print the throughput of decompression, "
+                        "parsing and extraction")
+    parser.add_argument('--compress', choices=sorted(sinks.COMPRESSORS),
+                        help="compress outfile on the fly")
+    parser.add_argument('--buffer-size', type=int, default=1024*1024,
+                        help="size of the output buffer in bytes")
+    parser.add_argument('--flush-bytes', type=int, default=None,
+                        help="flush the output after this many characters")
+    parser.add_argument('--flush-seconds', type=float, default=None,
+                        help="flush the output after this many seconds")
     parser.add_argument('outfile')
     args = parser.parse_args()
-    mode = args.mode
-    mwe = args.mwe
-    genre = args.genre
-    first = args.first_only
     outfile = directory + '/' + args.outfile
-    if mode == 'plain' and mwe == True:
+    if args.mode == 'plain' and args.mwe == True:
         print('Multi-Word Expressions are not available for plain mode\n')
         parser.print_help()
-    elif mode == 'plain' and first == True:
+    elif args.mode == 'plain' and args.first_only == True:
         print('First-only is not available for plain mode\n')
         parser.print_help()
+    elif postprocess.given_options(args) and not args.normalize:
+        print('{given} only apply with --normalize\n'.format(
+            given=', '.join(postprocess.given_options(args))))
+        parser.print_help()
+    elif args.workers > 1 and args.decompress_workers > 1:
+        print('Use either --workers or --decompress-workers above 1\n')
+        parser.print_help()
+    elif args.workers > 1 and args.mwe_workers > 1:
+        print('Use either --workers or --mwe-workers above 1\n')
+        parser.print_help()
+    elif args.workers > 1:
+        process_dir_parallel(directory, outfile, args, args.workers)
     else:
-        process_dir(directory)
+        process_dir(directory, outfile, args)
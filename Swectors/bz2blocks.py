@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import bz2
+import collections
+import mmap
+import multiprocessing
+import queue
+import threading
+import time
+
+
+# A bzip2 stream is a header followed by compressed blocks and an end of
+# stream marker. Blocks and the end marker start with these 48-bit magic
+# numbers, which are not aligned to bytes
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+# Every block is at most 900k long before compression, so a header for the
+# highest level can decompress any block
+STREAM_HEADER = b'BZh9'
+# Number of decompressed bytes handed on at a time when reading a file
+# sequentially, and the number of chunks or blocks waiting in the queue
+CHUNK_SIZE = 1024*1024
+QUEUE_SIZE = 16
+
+
+def find_magic(data, magic):
+    '''Returns the bit offsets of all occurrences of a 48-bit magic number
+    in data, at any bit alignment, in increasing order.'''
+    offsets = []
+    for shift in range(8):
+        if shift:
+            pattern = (magic << (8 - shift)).to_bytes(7, 'big')
+            needle, skip = pattern[1:6], 1
+        else:
+            pattern = magic.to_bytes(6, 'big')
+            needle, skip = pattern, 0
+        size = len(pattern)
+        pos = data.find(needle, skip)
+        while pos != -1:
+            start = pos - skip
+            value = int.from_bytes(data[start:start+size], 'big')
+            if len(data) - start >= size and (
+                    value >> (size*8 - MAGIC_BITS - shift)
+                    ) & ((1 << MAGIC_BITS) - 1) == magic:
+                offsets.append(start * 8 + shift)
+            pos = data.find(needle, pos + 1)
+    return sorted(offsets)
+
+
+def find_blocks(path):
+    '''Returns the blocks of a bzip2 file as a list of (start, end) bit
+    offsets, where start is the offset of the block magic and end that of
+    the next block or end of stream marker. Files made of several streams,
+    e.g. by pbzip2, are handled too.'''
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        if not f.tell():
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            starts = find_magic(data, BLOCK_MAGIC)
+            ends = find_magic(data, EOS_MAGIC)
+    blocks = []
+    for n, start in enumerate(starts):
+        i = bisect.bisect_right(ends, start)
+        end = ends[i] if i < len(ends) else None
+        if n + 1 < len(starts) and (end == None or starts[n+1] < end):
+            end = starts[n+1]
+        if end == None:
+            raise ValueError("Block at bit %d of %s has no end" % (start,
+                                                                  path))
+        blocks.append((start, end))
+    return blocks
+
+
+def block_stream(data, start, end):
+    '''Returns a complete bzip2 stream holding only the block between the
+    bit offsets start and end of data. Since the stream has one block, its
+    combined CRC is the CRC of the block.'''
+    first = start // 8
+    last = (end + 7) // 8
+    nbits = end - start
+    value = int.from_bytes(data[first:last], 'big') >> (last*8 - end)
+    value &= (1 << nbits) - 1
+    # The block CRC follows the block magic
+    crc = (value >> (nbits - MAGIC_BITS - 32)) & 0xffffffff
+    value = (((value << MAGIC_BITS) | EOS_MAGIC) << 32) | crc
+    nbits += MAGIC_BITS + 32
+    padding = -nbits % 8
+    return STREAM_HEADER + (value << padding).to_bytes((nbits + padding) // 8,
+                                                       'big')
+
+
+def decompress_block(task):
+    '''Worker function for iter_blocks. Decompresses one block of a file
+    and returns the data with the number of seconds it took.'''
+    path, start, end = task
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        f.seek(start // 8)
+        data = f.read((end + 7) // 8 - start // 8)
+    offset = start // 8 * 8
+    data = bz2.decompress(block_stream(data, start - offset, end - offset))
+    return data, time.perf_counter() - started
+
+
+def iter_blocks(path, workers, stats=None, blocks=None):
+    '''Yields the decompressed blocks of a bzip2 file in order, while a
+    pool of worker processes decompresses the following blocks. At most
+    twice as many blocks as there are workers are in flight at a time.
+    If blocks, a list of (start, end) bit offsets from find_blocks, is
+    given, only those blocks are decompressed.'''
+    if blocks == None:
+        blocks = find_blocks(path)
+    pending = collections.deque()
+    with multiprocessing.Pool(workers) as pool:
+        for start, end in blocks:
+            pending.append(pool.apply_async(decompress_block,
+                                            ((path, start, end),)))
+            if len(pending) >= 2 * workers:
+                data, seconds = pending.popleft().get()
+                if stats:
+                    stats.add('decompress', seconds, len(data))
+                yield data
+        while pending:
+            data, seconds = pending.popleft().get()
+            if stats:
+                stats.add('decompress', seconds, len(data))
+            yield data
+
+
+def iter_chunks(path, stats=None, chunk_size=CHUNK_SIZE):
+    '''Yields the decompressed contents of a bzip2 file in chunks, reading
+    it sequentially.'''
+    with bz2.BZ2File(path, 'rb') as f:
+        while True:
+            started = time.perf_counter()
+            data = f.read(chunk_size)
+            if stats:
+                stats.add('decompress', time.perf_counter() - started,
+                          len(data))
+            if not data:
+                break
+            yield data
+
+
+class PipelineReader(object):
+    '''A file-like object whose data is produced by a background thread
+    from an iterable of byte strings, e.g. iter_chunks or iter_blocks. The
+    thread runs at most queue_size items ahead of the reader, so memory
+    stays bounded. bz2 releases the GIL while decompressing, so reading
+    and parsing overlap with decompression even in a thread.'''
+
+    def __init__(self, chunks, stats=None, queue_size=QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        self.stats = stats
+        self.buffer = b''
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce, args=(chunks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self.put(chunk):
+                    return
+        except Exception as e:
+            self.put(e)
+            return
+        self.put(None)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.finished = True
+                raise item
+            if item == None:
+                self.finished = True
+            else:
+                self.buffer += item
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        if self.stats:
+            self.stats.add('read', time.perf_counter() - started, len(data))
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TimedReader(object):
+    '''Wraps a bz2.BZ2File to record the time spent reading from it, which
+    is all spent decompressing.'''
+
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        data = self.f.read(size)
+        seconds = time.perf_counter() - started
+        self.stats.add('decompress', seconds, len(data))
+        self.stats.add('read', seconds, len(data))
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_bz2(path, workers=0, stats=None):
+    '''Opens a bzip2 file for reading. With workers=0 it is decompressed
+    when read, as by bz2.BZ2File. With workers=1 a background thread
+    decompresses it ahead of the reader, and with more workers its blocks
+    are decompressed concurrently by that many processes.'''
+    if workers > 1:
+        return PipelineReader(iter_blocks(path, workers, stats), stats)
+    elif workers == 1:
+        return PipelineReader(iter_chunks(path, stats), stats)
+    elif stats:
+        return TimedReader(bz2.BZ2File(path, 'rb'), stats)
+    return bz2.BZ2File(path, 'rb')
+
+
+class PipelineStats(object):
+    '''Seconds spent and amounts processed per stage of an extraction.
+    'decompress' counts the seconds spent decompressing and the
+    decompressed bytes, summed over all threads and processes, and 'read'
+    the seconds the parser waited for data. Stages can be added from
+    several threads.'''
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.amounts = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, amount=0):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.amounts[stage] += amount
+
+    def timed(self, iterable, stage):
+        '''Yields the items of iterable, adding the time spent producing
+        each of them to stage.'''
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - started)
+                return
+            self.add(stage, time.perf_counter() - started, 1)
+            yield item
+
+    def report(self, wall):
+        '''Returns the throughput of each stage as lines of text, given the
+        wall clock time of the whole run. The parse time excludes the time
+        spent waiting for data. If the parser spent most of the run waiting,
+        decompression is the bottleneck.'''
+        mb = self.amounts['decompress'] / 1e6
+        decompress = self.seconds['decompress']
+        read = self.seconds['read']
+        parse = max(self.seconds['parse'] - read, 0.0)
+        sentences = self.amounts['parse']
+        extract = max(wall - self.seconds['parse'], 0.0)
+        lines = ["decompress: {mb:.1f} MB in {secs:.1f} s of work "
+                 "({rate:.1f} MB/s)".format(mb=mb, secs=decompress,
+                                            rate=mb / decompress
+                                            if decompress else 0.0),
+                 "parse: {n} sentences in {secs:.1f} s ({rate:.1f} MB/s)"
+                 .format(n=sentences, secs=parse,
+                         rate=mb / parse if parse else 0.0),
+                 "extract and write: {secs:.1f} s ({rate:.0f} sentences/s)"
+                 .format(secs=extract,
+                         rate=sentences / extract if extract else 0.0),
+                 "waited for data: {secs:.1f} s of {wall:.1f} s"
+                 .format(secs=read, wall=wall)]
+        return lines
@@ -2,16 +2,54 @@
 # -*- coding: utf-8 -*-
 # Author: Stian Rødven Eide
 
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
+import collections
 import re
-import os
 import sys
-import codecs
 import itertools as it
-import bz2
+
+# Compiled patterns for the lex annotations
+REF_RE = re.compile(':\d+')
+REF_POST_RE = re.compile('(.+:)(\d+)')
+ENDS_WITH_REF_RE = re.compile('.+:\d+$')
+SENSE_RE = re.compile('\.\..+')
+
+# The same lex strings recur throughout a corpus, so the parsed forms of
+# each lex are kept in interned tables instead of being recomputed
+_stripped_refs = {}
+_stripped_senses = {}
+_compressed_lexes = {}
+
+# Results of check_mwe keyed on the annotation signature of a sentence.
+# Each process keeps the MWE_CACHE_SIZE most recently used ones, since the
+# sentences that recur most are found with a small cache as well
+MWE_CACHE_SIZE = 10000
+_mwe_cache = collections.OrderedDict()
+_mwe_stats = {'hits': 0, 'misses': 0}
+
+# Sentences with more combinations of unsure lexes than COMBINATION_LIMIT
+# are resolved with at most SEARCH_LIMIT steps per search
+COMBINATION_LIMIT = 500000
+SEARCH_LIMIT = 200000
+
+
+def strip_ref(lex):
+    '''Returns a lex without its reference numbers, e.g. slå_fast..vbm.1
+    for slå_fast..vbm.1:11.'''
+    try:
+        return _stripped_refs[lex]
+    except KeyError:
+        stripped = _stripped_refs[lex] = sys.intern(REF_RE.sub('', lex))
+        return stripped
+
+
+def strip_sense(lex):
+    '''Returns a lex without its POS and sense number, e.g. slå_fast for
+    slå_fast..vbm.1:11.'''
+    try:
+        return _stripped_senses[lex]
+    except KeyError:
+        stripped = _stripped_senses[lex] = sys.intern(SENSE_RE.sub('', lex))
+        return stripped
 
 
 def combination_to_out(combination, savelex):
@@ -40,15 +78,15 @@ def combination_to_out(combination, savelex):
                 # We set ref_post to the number after the colon. If the colon
                 # signifies something else, we save and continue
                 try:
-                    ref_post = re.match('(.+:)(\d+)', combination[0]).group(2)
+                    ref_post = REF_POST_RE.match(combination[0]).group(2)
                 except AttributeError:
                     savelex[i] = combination[0]
                     combination.pop(0)
                     continue
                 # We see whether it matches whatever it refers to
                 if (int(ref_post)-1) in savelex:
-                    if (re.sub(':\d+','',combination[0]) ==
-                        re.sub(':\d+','',savelex[int(ref_post)-1])):
+                    if (strip_ref(combination[0]) ==
+                        strip_ref(savelex[int(ref_post)-1])):
                         # And if so, delete that item
                         savelex.pop(i)
                         combination.pop(0)
@@ -60,72 +98,295 @@ def combination_to_out(combination, savelex):
     return lexes_out
 
 
-def get_valid_combinations(combinations, savelex):
-    '''A helper function to remove combinations of lexes that we know
-    are referentially invalid. This can either be that a lex C refers
-    to a lex B that refers to a lex A, or that a lex refers to another
-    lex that doesn't exist.'''
-    # We need to update this now, since we have joined the strings of
-    # various options
-    valid_combinations = [c for c in combinations]
-    for c in combinations:
-        removed = False
-        mwes = [l for l in c if sep in l and
-                not (l.startswith(sep) or l.startswith('http'))]
-        # If there are no MWEs, the combination is probably valid
-        if not mwes:
-            continue
-        # If a MWE-lex only matches itself, we discard the combination
-        for l in mwes:
-            matches = [l2 for l2 in mwes
-                       if re.sub('\.\..+','',l2) == re.sub('\.\..+','',l)]
-            if len(matches) == 1:
-                valid_combinations.remove(c)
-                removed = True
-                break
-        if removed == True:
-            continue
-        # We make a copy of c and savelex so that we can manipulate them
-        tmpc = [l for l in c]
-        tmpsavelex = {k:savelex[k] for k in savelex}
-        # We populate the temporary savelex, replacing all instances of
-        # None with the lexes from the current combination
-        for i in sorted(tmpsavelex):
-            if tmpsavelex[i] == None:
-                tmpsavelex[i] = tmpc[0]
-                tmpc.pop(0)
-        # We go through the fully populated temporary savelex, checking
-        # that all references are valid
-        for i in sorted(tmpsavelex):
-            # If the current MWE lex has a referencing number
-            if (sep in tmpsavelex[i] and ':' in tmpsavelex[i]
-                and not tmpsavelex[i].startswith(sep)):
-                # we get the lex base and its ref number
-                clist = tmpsavelex[i].split(':')
-                ref = clist[-1]
-                lbase = ':'.join(clist[:-1])
-                lbase = lbase.split('..')[0]
-                try:
-                    ref = int(ref)
-                except ValueError:
-                    break
-                try:
-                    reflex = tmpsavelex[ref-1]
-                except KeyError:
-                    valid_combinations.remove(c)
-                    break
-                refbase = reflex.split('..')[0]
-                # If whatever the lex refers to has a colon we know
-                # that it is invalid and remove the combination
-                if ':' in reflex:
-                    valid_combinations.remove(c)
-                    break
-                # If the base of the lex differs from the lex it
-                # refers to, it is also invalid
-                elif not lbase == refbase:
-                    valid_combinations.remove(c)
-                    break
-    return valid_combinations
+def is_valid_combination(c, savelex):
+    '''Returns whether a combination of lexes is referentially valid. It
+    is not if a lex C refers to a lex B that refers to a lex A, or if a lex
+    refers to another lex that doesn't exist. CombinationSearch uses this
+    to check the combinations it completes.'''
+    mwes = [l for l in c if sep in l and
+            not (l.startswith(sep) or l.startswith('http'))]
+    # If there are no MWEs, the combination is probably valid
+    if not mwes:
+        return True
+    # If a MWE-lex only matches itself, we discard the combination
+    bases = {}
+    for l in mwes:
+        lbase = strip_sense(l)
+        bases[lbase] = bases.get(lbase, 0) + 1
+    if 1 in bases.values():
+        return False
+    # We make a copy of savelex so that we can manipulate it
+    tmpsavelex = {k:savelex[k] for k in savelex}
+    # We populate the temporary savelex, replacing all instances of
+    # None with the lexes from the current combination
+    j = 0
+    for i in sorted(tmpsavelex):
+        if tmpsavelex[i] == None:
+            tmpsavelex[i] = c[j]
+            j += 1
+    # We go through the fully populated temporary savelex, checking
+    # that all references are valid
+    for i in sorted(tmpsavelex):
+        # If the current MWE lex has a referencing number
+        if (sep in tmpsavelex[i] and ':' in tmpsavelex[i]
+            and not tmpsavelex[i].startswith(sep)):
+            # we get the lex base and its ref number
+            clist = tmpsavelex[i].split(':')
+            ref = clist[-1]
+            lbase = ':'.join(clist[:-1])
+            lbase = lbase.split('..')[0]
+            try:
+                ref = int(ref)
+            except ValueError:
+                return True
+            try:
+                reflex = tmpsavelex[ref-1]
+            except KeyError:
+                return False
+            refbase = reflex.split('..')[0]
+            # If whatever the lex refers to has a colon we know
+            # that it is invalid and remove the combination
+            if ':' in reflex:
+                return False
+            # If the base of the lex differs from the lex it
+            # refers to, it is also invalid
+            elif not lbase == refbase:
+                return False
+    return True
+
+
+def mwe_words(l):
+    '''Returns the number of underscores in the base of a lex, which
+    CombinationSearch uses to count the words used in MWEs.'''
+    if '..' in l and not (l.startswith(sep) or l.startswith('http')):
+        return len(l.split('..')[0].split(sep)) - 1
+    return 0
+
+
+def parse_ref(lex):
+    '''Returns how is_valid_combination reads the reference of a lex:
+    None if it has none, True if the reference is not a number, and
+    otherwise the base of the lex and the position it refers to, counted
+    from zero.'''
+    if sep in lex and ':' in lex and not lex.startswith(sep):
+        clist = lex.split(':')
+        try:
+            return ':'.join(clist[:-1]).split('..')[0], int(clist[-1]) - 1
+        except ValueError:
+            return True
+    return None
+
+
+class CombinationSearch(object):
+    '''A depth-first search over the combinations of unsure lexes, one
+    word position at a time, that replaces generating the full product of
+    the lists in uslist. Partial combinations are pruned as soon as they
+    cannot be completed into a combination that is_valid_combination
+    accepts, and the searches visit the combinations in the order of
+    it.product(*uslist), so the results are those that filtering the
+    whole product would give.
+
+    Sentences used to be skipped when they had more than COMBINATION_LIMIT
+    combinations. For those, each search visits at most SEARCH_LIMIT
+    partial combinations and at most COMBINATION_LIMIT combinations are
+    kept, so the best combination found within those limits is used.'''
+
+    def __init__(self, uslist, savelex):
+        self.uslist = uslist
+        self.savelex = savelex
+        self.positions = sorted(savelex)
+        # The word positions of the unsure lexes, in the order of uslist
+        self.slots = [i for i in self.positions if savelex[i] == None]
+        # Each lex is parsed once per sentence
+        lexes = set(l for ls in uslist for l in ls)
+        self.mwe_bases = {l: strip_sense(l) for l in lexes if sep in l and
+                          not (l.startswith(sep) or l.startswith('http'))}
+        self.words = {l: mwe_words(l) for l in lexes}
+        lexes.update(l for l in savelex.values() if l != None)
+        self.refs = {l: parse_ref(l) for l in lexes}
+        self.bases = {l: l.split('..')[0] for l in lexes}
+        # The MWE bases that can still occur after each depth, for the
+        # check that no MWE lex is left matching only itself
+        self.later_bases = [set() for _ in range(len(uslist) + 1)]
+        for d in range(len(uslist) - 1, -1, -1):
+            self.later_bases[d] = self.later_bases[d+1] | set(
+                self.mwe_bases[l] for l in uslist[d] if l in self.mwe_bases)
+        # The most MWE words that each depth and the rest can contribute
+        self.later_words = [0] * (len(uslist) + 1)
+        for d in range(len(uslist) - 1, -1, -1):
+            self.later_words[d] = (self.later_words[d+1] +
+                                   max(self.words[l] for l in uslist[d]))
+        # The positions checked after choosing the lex at each depth: the
+        # unsure word itself and the saved words up to the next unsure one
+        bounds = [0] + [self.positions.index(i) for i in self.slots[1:]] + [
+            len(self.positions)]
+        self.segments = [self.positions[bounds[d]:bounds[d+1]]
+                         for d in range(len(uslist))]
+        size = 1
+        for lexes in uslist:
+            size *= len(lexes)
+        # Small searches are never cut short, so that they give exactly
+        # the results of the product
+        self.limit = SEARCH_LIMIT if size > COMBINATION_LIMIT else None
+
+    def first_combination(self):
+        '''The first combination with an MWE for the first lex, if it
+        exists, or otherwise the first combination.'''
+        rest = tuple(l[0] for l in self.uslist[1:])
+        for l in self.uslist[0]:
+            if sep in l and not l.startswith(sep):
+                return (l,) + rest
+        return (self.uslist[0][0],) + rest
+
+    def check_refs(self, depth, refs):
+        '''Continues the reference check of is_valid_combination after
+        the lex at depth has been chosen. refs is (passed, failed,
+        waiting) for the words before it, where passed tells whether the
+        check has reached a reference that is not a number, after which
+        nothing else is checked, failed whether a reference is known to be
+        invalid, and waiting maps the positions of unassigned words to the
+        bases of the lexes that refer to them.'''
+        passed, failed, waiting = refs
+        assigned = self.assigned
+        slot = self.slots[depth]
+        if slot in waiting:
+            reflex = assigned[slot]
+            for lbase in waiting[slot]:
+                if ':' in reflex or lbase != self.bases[reflex]:
+                    failed = True
+            waiting = dict(waiting)
+            del waiting[slot]
+        if passed or failed:
+            return passed, failed, waiting
+        # The words up to the next unassigned one are checked in word
+        # order, as in is_valid_combination
+        for i in self.segments[depth]:
+            ref = self.refs[assigned[i]]
+            if ref == None:
+                continue
+            if ref == True:
+                return True, failed, waiting
+            lbase, ref = ref
+            if ref not in assigned:
+                return passed, True, waiting
+            reflex = assigned[ref]
+            if reflex == None:
+                waiting = dict(waiting)
+                waiting[ref] = waiting.get(ref, ()) + (lbase,)
+            elif ':' in reflex or lbase != self.bases[reflex]:
+                return passed, True, waiting
+        return passed, failed, waiting
+
+    def can_complete(self, depth, failed):
+        '''Returns False if no completion of the current partial
+        combination of depth lexes can be valid. This is conservative: True
+        means that a completion might be valid.'''
+        # An MWE base that occurs only once so far must occur again later
+        later = self.later_bases[depth]
+        for lbase, count in self.counts.items():
+            if count == 1 and lbase not in later:
+                return False
+        # References are not checked for combinations without MWE lexes
+        return not (failed and self.counts)
+
+    def combinations(self, options=None, bound=None):
+        '''Yields the valid combinations in the order of the product of
+        options, which defaults to uslist. bound(depth, words) can prune
+        partial combinations by the number of MWE words in them.'''
+        if options is None:
+            options = self.uslist
+        self.budget = self.limit
+        self.assigned = dict(self.savelex)
+        self.counts = {}
+        return self._search(options, (), 0, (False, False, {}), bound)
+
+    def _search(self, options, choices, words, refs, bound):
+        depth = len(choices)
+        if depth == len(options):
+            if is_valid_combination(choices, self.savelex):
+                yield choices
+            return
+        slot = self.slots[depth]
+        for l in options[depth]:
+            if self.budget != None:
+                if self.budget <= 0:
+                    return
+                self.budget -= 1
+            lwords = words + self.words[l]
+            if bound and not bound(depth + 1, lwords):
+                continue
+            lbase = self.mwe_bases.get(l)
+            if lbase != None:
+                self.counts[lbase] = self.counts.get(lbase, 0) + 1
+            self.assigned[slot] = l
+            lrefs = self.check_refs(depth, refs)
+            if self.can_complete(depth + 1, lrefs[1]):
+                for c in self._search(options, choices + (l,), lwords, lrefs,
+                                      bound):
+                    yield c
+            self.assigned[slot] = None
+            if lbase != None:
+                self.counts[lbase] -= 1
+                if not self.counts[lbase]:
+                    del self.counts[lbase]
+
+    def first_valid(self, n):
+        '''Returns the first n valid combinations.'''
+        return list(it.islice(self.combinations(), n))
+
+    def first_single_mwe(self):
+        '''Returns the first valid combination where all words are part of
+        one MWE as long as the combination, or None.'''
+        for first in self.uslist[0]:
+            if first.startswith(sep) or len(first.split(sep)) != len(
+                    self.uslist):
+                continue
+            base = strip_ref(first)
+            options = [[first]] + [[l for l in lexes if strip_ref(l) == base]
+                                   for lexes in self.uslist[1:]]
+            for c in self.combinations(options):
+                return c
+        return None
+
+    def max_mwe_words(self):
+        '''Returns the most words used in MWEs by a valid combination,
+        trying the lexes with the most MWE words first.'''
+        best = [-1]
+
+        def bound(depth, words):
+            return words + self.later_words[depth] > best[0]
+
+        options = [sorted(lexes, key=self.words.get, reverse=True)
+                   for lexes in self.uslist]
+        self.best = None
+        for c in self.combinations(options, bound):
+            words = sum(self.words[l] for l in c)
+            if words > best[0]:
+                best[0] = words
+                self.best = c
+        return best[0]
+
+    def max_mwe_combinations(self):
+        '''Returns the valid combinations with the most words used in
+        MWEs, counted by mwe_words, in product order.'''
+        best = [self.max_mwe_words()]
+        found = []
+
+        def bound(depth, words):
+            return words + self.later_words[depth] >= best[0]
+
+        for c in self.combinations(bound=bound):
+            words = sum(self.words[l] for l in c)
+            if words > best[0]:
+                best[0] = words
+                found = []
+            if words == best[0] and len(found) < COMBINATION_LIMIT:
+                found.append(c)
+        # A search that was cut short may not reach the best combination
+        # in product order
+        if not found and self.best:
+            found.append(self.best)
+        return found
 
 
 def comp_lex(lex):
@@ -134,8 +395,18 @@ def comp_lex(lex):
     is in order to compare two lex/saldo values to see if they are
     similar enough to be joined.
     '''
+    try:
+        return _compressed_lexes[lex]
+    except KeyError:
+        fcomp = _compressed_lexes[lex] = sys.intern(_comp_lex(lex))
+        return fcomp
+
+
+def _comp_lex(lex):
+    '''Does the work of comp_lex for lexes that are not yet in the
+    table.'''
     # If it ends with a colon, followed by digits
-    if re.match('.+:\d+$',lex):
+    if ENDS_WITH_REF_RE.match(lex):
         # we set fbase to everything before the colon
         # and fref to the digits after the colon
         flist = lex.split(':')
@@ -157,88 +428,19 @@ def join_identicals(lexes):
     '''A helper function to join lexes we are unable to choose one of.
     Works only for saldo/lex modes
     In the case that there are items in the input list that have identical
-    bases, i.e. the only difference is the SALDO POS or number, we remove all
-    but the first one.'''
-    # Trying from scratch
-    newlexes = []
-    while lexes:
-        # fl = first_of_list, rl = rest_of_list
-        fl, rl = lexes[0], lexes[1:]
-        fcomp = comp_lex(fl)
-        rcomps = [comp_lex(l) for l in rl]
-        if fcomp not in rcomps:
-            newlexes.append(fl)
-            lexes.pop(0)
-            continue
-        else:
-            tojoin = [fl]
-            for l in rl:
-                rcomp = comp_lex(l)
-                if fcomp == rcomp:
-                    tojoin.append(l)
-            for l in tojoin:
-                lexes.remove(l)
-            newlexes.append('|'.join(tojoin))
-    return newlexes
-
-
-def remove_identicals(full_list):
-    '''A helper function to remove lexes we know we don't need.
-    It should work with a list of lexes for a single word or with a list
-    of lists of lexes for a whole sentence.
-    In the case that there are items in the input list that have identical
-    bases, i.e. the only difference is the SALDO POS or number, we remove all
-    but the first one.'''
-    # We make reduced_list a copy of the input list
-    reduced_list = [c for c in full_list]
-    for i, c in enumerate(full_list):
-        # If the items in the list are lists or tuples, we join
-        # them to a string
-        if type(c) == tuple or type(c) == list:
-            c = ' '.join(c)
-        # We remove everything except the base from the lex(es)
-        # ex: slå_fast..vbm.1:11 -> slå_fast
-        cstrip = re.sub('\.{2}.+?\d+:?\d*','',c)
-        # Unless we are at the final item in the list, we compare the base
-        # of the lex(es) to the rest of the list. If the base of an item in the
-        # rest of the list is identical to the base of the current item, we
-        # remove it.
-        if len(full_list) > i:
-            for c2 in full_list[i+1:]:
-                if type(c2) == tuple or type(c) == list:
-                    c2 = ' '.join(c2)
-                c2strip = re.sub('\.{2}.+?\d+:?\d*','',c2)
-                if c2strip == cstrip:
-                    if c2 in reduced_list:
-                        reduced_list.remove(c2)
-    return reduced_list
-
-
-def get_max_mwe_words(combinations):
-    '''A helper function that finds the maximum number of MWE words
-    possible among the combinations and removes all combinations that
-    have fewer MWE words than that number. It does so by counting
-    underscores, which should correspond to MWEs. It should, however,
-    not be used before removing referentially invalid combinations'''
-    max_combinations = []
-    max_underscores = -1
-    for c in combinations:
-        underscores = 0
-        for l in c:
-            if '..' in l and not (l.startswith(sep) or l.startswith('http')):
-                lbase = l.split('..')[0]
-                underscores += (len(lbase.split(sep))-1)
-        if underscores > max_underscores:
-            max_underscores = underscores
-    for c in combinations:
-        underscores = 0
-        for l in c:
-            if '..' in l and not (l.startswith(sep) or l.startswith('http')):
-                lbase = l.split('..')[0]
-                underscores += (len(lbase.split(sep))-1)
-        if underscores == max_underscores:
-            max_combinations.append(c)
-    return max_combinations
+    bases, i.e. the only difference is the SALDO POS or number, we join
+    them with a pipe symbol at the position of the first one.'''
+    # We group the lexes by their compressed form in a single pass,
+    # keeping the groups in the order of their first lex
+    groups = {}
+    order = []
+    for l in lexes:
+        fcomp = comp_lex(l)
+        if fcomp not in groups:
+            groups[fcomp] = []
+            order.append(fcomp)
+        groups[fcomp].append(l)
+    return ['|'.join(groups[fcomp]) for fcomp in order]
 
 
 def remove_leading_non_mwes(combinations, savelex):
@@ -298,14 +500,14 @@ def get_best_leftmost(combinations):
     # with the longest first MWE
     for c in combinations:
         counter = len([l for l in c if
-                       re.sub(':\d+','',l) == re.sub(':\d+','',c[0])])
+                       strip_ref(l) == strip_ref(c[0])])
         if counter > maxlen:
             maxlen = counter
     # Then we remove all combinations where the first MWE is shorter
     # than the longest first MWE
     for c in combinations:
         counter = len([l for l in c if
-                       re.sub(':\d+','',l) == re.sub(':\d+','',c[0])])
+                       strip_ref(l) == strip_ref(c[0])])
         if counter == maxlen:
             reduced_combinations.append(c)
     return reduced_combinations
@@ -329,7 +531,7 @@ def get_most_compact(combinations):
     for c in combinations:
         mwedist = 0
         for i, l in enumerate(c):
-            if re.sub(':\d+','',l) == re.sub(':\d+','',c[0]):
+            if strip_ref(l) == strip_ref(c[0]):
                 mwedist = i
         if mindist == None or mwedist < mindist:
             mindist = mwedist
@@ -338,7 +540,7 @@ def get_most_compact(combinations):
     for c in combinations:
         mwedist = 0
         for i, l in enumerate(c):
-            if re.sub(':\d+','',l) == re.sub(':\d+','',c[0]):
+            if strip_ref(l) == strip_ref(c[0]):
                 mwedist = i
         if mwedist == mindist:
             reduced_combinations.append(c)
@@ -376,7 +578,7 @@ def save_first_mwe(combinations, savelex):
     # pointing to the first one, we mark them to be removed, keeping
     # only the first.
     for i, l in enumerate(combinations[0][1:]):
-        if re.sub(':\d+','',l) == re.sub(':\d+','',first_mwe_lex) and ':' in l:
+        if strip_ref(l) == strip_ref(first_mwe_lex) and ':' in l:
             if int(l.split(':')[-1]) == ref:
                 mwe_positions.append(i+1)
                 to_be_removed.append(l)
@@ -427,6 +629,54 @@ def check_mwe(sentence, mode):
     the leftmost MWE. While this should take care of nearly all cases,
     we might update the code with a third heuristic to choose the most
     compact MWE.'''
+    words = []
+    values = []
+    for w in sentence:
+        # Sometimes there are other elements than <w> in a sentence
+        # element. Whenever that is the case, we return None
+        if w.tag != 'w':
+            return None
+        words.append(w.text)
+        values.append(w.attrib[mode])
+    return contract_words(words, values, mode)
+
+
+def annotation_signature(words, values):
+    '''Returns a key that identifies the result of contracting a sentence.
+    The word itself only matters when it has no annotation.'''
+    return tuple(v if v.strip('|') else (v, w) for w, v in zip(words, values))
+
+
+def contract_words(words, values, mode):
+    '''Does the work of check_mwe for a sentence given as a list of
+    words and a list of their lemma, saldo or lex attributes. The results
+    are memoized on the annotation signature of the sentence, since the
+    same annotations recur many times in a corpus.'''
+    key = (mode, annotation_signature(words, values))
+    try:
+        result = _mwe_cache[key]
+        _mwe_cache.move_to_end(key)
+        _mwe_stats['hits'] += 1
+    except KeyError:
+        _mwe_stats['misses'] += 1
+        if len(_mwe_cache) >= MWE_CACHE_SIZE:
+            _mwe_cache.popitem(last=False)
+        result = _mwe_cache[key] = _contract_words(words, values, mode)
+    if result is None:
+        return None
+    return list(result)
+
+
+def cache_info():
+    '''Returns the number of hits and misses of the check_mwe cache and
+    the hit rate.'''
+    total = _mwe_stats['hits'] + _mwe_stats['misses']
+    rate = _mwe_stats['hits'] / total if total else 0.0
+    return _mwe_stats['hits'], _mwe_stats['misses'], rate
+
+
+def _contract_words(words, values, mode):
+    '''Contracts the MWEs of a sentence that is not in the cache.'''
     global sep
     # We set the separator to space if the mode is lemma, otherwise
     # to underscore
@@ -436,18 +686,14 @@ def check_mwe(sentence, mode):
         sep = '_'
     # We make a list of lists of lexes:
     lexlists = []
-    for w in sentence:
-        # Sometimes there are other elements than <w> in a sentence
-        # element. Whenever that is the case, we return None
-        if w.tag != 'w':
-            return None
+    for text, value in zip(words, values):
         # For some reason, the parser have troubles with words
         # sometimes, setting them to None, which causes errors
-        if w.text == None:
-            w.text = 'noword'
+        if text == None:
+            text = 'noword'
         # The pipe symbol | is used as a separator in the annotation
         # lexes is a list of lexes for a given word
-        lexes = [l for l in w.attrib[mode].split('|') if l]
+        lexes = [l for l in value.split('|') if l]
         # We check how many MWE lexes there are for the current word
         mwes = [l for l in lexes if sep in l and not l.startswith(sep)
                 and not l.startswith('http')]
@@ -460,7 +706,7 @@ def check_mwe(sentence, mode):
         # If there are no lexes for the current word, we append the
         # word instead
         elif len(lexes) == 0:
-            lexlists.append([w.text])
+            lexlists.append([text])
         # If there are lexes for the current word, but no MWE, we
         # choose the first lex
         else:
@@ -469,8 +715,7 @@ def check_mwe(sentence, mode):
     # If there are no MWE's in the sentence, we return a list of the
     # first lex of each word. We assume that there is an MWE if any lex
     # has an underscore which is not at the beginning of the string
-    if not [w.attrib[mode] for w in sentence if sep in w.attrib[mode] and not
-            w.attrib[mode].startswith(sep)]:
+    if not [v for v in values if sep in v and not v.startswith(sep)]:
         # We flatten the list before returning it
         lexes_out = [lex for wlexes in lexlists for lex in wlexes]
         return lexes_out
@@ -507,13 +752,13 @@ def check_mwe(sentence, mode):
             # We make a flat list of all lexes for all words in the
             # sentence except for the word we are working on
             all_except_current = lexlists[:i] + lexlists[i+1:]
-            all_flat = [re.sub(':\d+','',i) for l
-                        in all_except_current for i in l]
+            all_flat = set(strip_ref(i) for l
+                           in all_except_current for i in l)
             # We check whether the MWE lexes for the current word matches
             # the lexes for any other words in the sentence
             identicals = False
             for l in mwes:
-                if re.sub(':\d+','',l) in all_flat:
+                if strip_ref(l) in all_flat:
                     identicals = True
                     break
             # If we don't find a match, we save it
@@ -535,79 +780,30 @@ def check_mwe(sentence, mode):
     # In case our uncertain list is empty, we return our saved items
     if not uslist:
         return [savelex[i] for i in sorted(savelex)]
-    # In case we have a big uslist, the number of combinations might
-    # become enormous. We should preferably pre-process the uslist
-    # whenever that happens, but for now, we'll simply set 33 as a
-    # cutoff. If the flat uslist is bigger than that, we choose the
-    # first possible combination. We write the uslist to a log file
-    # to make it easier to handle it properly later.
-
-    # Instead of flattening the list, we calculate the product
-    # beforehand:
-    comblength = 1
-    uslengths = [len(l) for l in uslist]
-    for i in uslengths:
-        comblength *= i
-
-    if comblength > 500000:
-        print("Too many combinations!: %s" % comblength)
-        print("Skipping")
-        with open('flatuslog.txt', 'a+') as logfile:
-            logfile.write("------------------")
-            for l in uslist:
-                lstring = ' '.join(l)
-                logfile.write(lstring + '\n')
-        return None
 
-    # We generate all combinations of the unsure ones
-    combinations = it.product(*uslist)
-    # We convert the generator into a list
-    combinations = [c for c in combinations]
-    # Then we remove all combinations that are referentially invalid
-    valid_combinations = get_valid_combinations(combinations, savelex)
+    # Instead of generating every combination of the unsure lexes, we
+    # search them word by word, pruning partial combinations as soon as
+    # they are referentially invalid. The searches visit the valid
+    # combinations in the same order as it.product(*uslist) would.
+    search = CombinationSearch(uslist, savelex)
+    first_valid = search.first_valid(2)
     # In some cases, Korp's annotation doesn't provide any valid
     # combinations. In this case, we choose either the first
     # combination with an MWE for the first lex, if it exists, or, if
     # it doesn't, the first combination there is
-    if not valid_combinations:
-        for c in combinations:
-            if sep in c[0] and not c[0].startswith(sep):
-                return combination_to_out(c, savelex)
-        return combination_to_out(combinations[0], savelex)
-
-    # In case the list of combinations is really large, we delete it
-    del combinations
-
-    # We remove all combinations that are identical to another
-    # combination except for the SALDO numbers being different,
-    # keeping only the first
-    valid_combinations = remove_identicals(valid_combinations)
-
-    # At some point I get empty combinations. I need to find out what causes
-    # that. For the time being, we'll just remove them
-    # The following four lines should  be removed after one more round of testing
-    valid_combinations = [c for c in valid_combinations if c]
-    unsures = [i for i in sorted(savelex) if savelex[i] == None]
-    if not unsures:
-        return [savelex[i] for i in sorted(savelex)]
+    if not first_valid:
+        return combination_to_out(search.first_combination(), savelex)
 
     # Do we have only one valid combination? Choose that!
-    if len(valid_combinations) == 1:
-        return combination_to_out(valid_combinations[0], savelex)
+    if len(first_valid) == 1:
+        return combination_to_out(first_valid[0], savelex)
     # Do we have the option to use all words in one MWE? Choose that!
-    for c in valid_combinations:
-        # We check that the length of the MWE is equal to the number
-        # of lexes in the combination
-        if not c[0].startswith(sep) and len(c[0].split(sep)) == len(c):
-            # We check whether all words in the combination are part of
-            # the same MWE
-            sameas = [l for l in c if
-                      re.sub(':\d+','',l) == re.sub(':\d+','',c[0])]
-            if len(sameas) == len(c):
-                return combination_to_out(c, savelex)
+    c = search.first_single_mwe()
+    if c:
+        return combination_to_out(c, savelex)
     # We reduce the list of combinations to the one(s) with the most
     # words used in MWEs
-    max_combinations = get_max_mwe_words(valid_combinations)
+    max_combinations = search.max_mwe_combinations()
     # We also check whether we are finished and return if we are
     if len(max_combinations) == 1:
         return combination_to_out(max_combinations[0], savelex)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bz2
+import collections
+import xml.parsers.expat
+
+
+# Number of bytes handed to the parser at a time
+CHUNK_SIZE = 1024*1024
+
+
+class Sentence(collections.namedtuple('Sentence', ['words', 'values', 'tags',
+                                                   'text'])):
+    '''A sentence of a Korp corpus. words holds the text of each element
+    in the sentence (None if it is empty) and values the requested
+    attribute of each element (None if it is missing or no attribute was
+    requested). tags holds the tag of each element, which is 'w' for words.
+    text is the dictionary of attributes of the enclosing <text> element.'''
+
+    __slots__ = ()
+
+    @property
+    def genre(self):
+        return self.text.get('genre')
+
+
+def text_year(attrs):
+    '''Returns the year of a <text> element as a string, from its year
+    attribute or the first four characters of its date or datefrom
+    attribute, or None if it has none of them.'''
+    for name in ('year', 'date', 'datefrom'):
+        if attrs.get(name):
+            return attrs[name][:4]
+    return None
+
+
+def text_filter(conditions):
+    '''Returns a predicate on the attributes of <text> elements that
+    accepts a text if, for each attribute name in the dictionary conditions,
+    its value is in the corresponding set of values. The name 'year' is
+    matched against text_year. Texts that lack an attribute are accepted.
+    Returns None if there are no conditions.'''
+    if not conditions:
+        return None
+
+    def accept(attrs):
+        for name, values in conditions.items():
+            if name == 'year':
+                value = text_year(attrs)
+            else:
+                value = attrs.get(name)
+            if value != None and value not in values:
+                return False
+        return True
+    return accept
+
+
+def open_corpus(path):
+    '''Opens a Korp xml file, bzipped or not, for reading bytes.'''
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+
+class KorpReader(object):
+    '''A streaming reader for Korp xml files based on the expat parser.
+    Iterating over it yields one Sentence per <sentence> element, in file
+    order. Only the sentence being parsed and the sentences completed
+    within the last chunk are kept in memory, and no element tree is built,
+    so memory use does not grow with the size of the file.
+
+    attribute is the word attribute to collect, e.g. 'lemma', 'saldo' or
+    'lex', or None to only collect the words.
+
+    If accept_text, e.g. from text_filter, is given, <text> elements whose
+    attributes it rejects are skipped as a whole: the parser runs through
+    them with handlers that only count their sentences, so no sentences are
+    built and their character data is never passed on.
+    The numbers of texts seen and skipped and of sentences skipped are kept
+    in texts, skipped_texts and skipped_sentences.'''
+
+    def __init__(self, infile, attribute=None, chunk_size=CHUNK_SIZE,
+                 accept_text=None):
+        self.infile = infile
+        self.attribute = attribute
+        self.chunk_size = chunk_size
+        self.accept_text = accept_text
+        self.texts = 0
+        self.skipped_texts = 0
+        self.skipped_sentences = 0
+        self.parser = None
+        self.skip_depth = None
+        self.text = {}
+        self.depth = 0
+        # The depth of the current sentence element, or None outside
+        # sentences
+        self.sentence_depth = None
+        self.words = []
+        self.values = []
+        self.tags = []
+        # The character data of the current word, or None when the text
+        # of the current word has ended
+        self.chars = None
+        self.done = []
+
+    def start(self, tag, attrs):
+        self.depth += 1
+        if self.sentence_depth != None:
+            if self.depth == self.sentence_depth + 1:
+                self.tags.append(tag)
+                self.values.append(attrs.get(self.attribute))
+                self.chars = []
+            else:
+                # Like ElementTree, the text of a word only runs up to its
+                # first child element
+                self.end_chars()
+        elif tag == 'sentence':
+            self.sentence_depth = self.depth
+        elif tag == 'text':
+            self.texts += 1
+            if self.accept_text and not self.accept_text(attrs):
+                self.skip_text()
+            else:
+                self.text = attrs
+
+    def skip_text(self):
+        '''Switches to the handlers for skipped texts, which only keep
+        track of the depth and count sentences, until the text ends.'''
+        self.skipped_texts += 1
+        self.skip_depth = self.depth
+        self.parser.StartElementHandler = self.skip_start
+        self.parser.EndElementHandler = self.skip_end
+        self.parser.CharacterDataHandler = None
+
+    def skip_start(self, tag, attrs):
+        self.depth += 1
+        if tag == 'sentence':
+            self.skipped_sentences += 1
+
+    def skip_end(self, tag):
+        if self.depth == self.skip_depth:
+            self.set_handlers()
+        self.depth -= 1
+
+    def set_handlers(self):
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.characters
+
+    def end_chars(self):
+        if self.chars != None:
+            self.words.append(''.join(self.chars) or None)
+            self.chars = None
+
+    def end(self, tag):
+        if self.sentence_depth != None:
+            if self.depth == self.sentence_depth + 1:
+                self.end_chars()
+            elif self.depth == self.sentence_depth:
+                self.done.append(Sentence(self.words, self.values, self.tags,
+                                          self.text))
+                self.words = []
+                self.values = []
+                self.tags = []
+                self.sentence_depth = None
+        elif tag == 'text':
+            self.text = {}
+        self.depth -= 1
+
+    def characters(self, data):
+        if self.chars != None:
+            self.chars.append(data)
+
+    def __iter__(self):
+        parser = self.parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        self.set_handlers()
+        while True:
+            chunk = self.infile.read(self.chunk_size)
+            parser.Parse(chunk, not chunk)
+            done, self.done = self.done, []
+            for sentence in done:
+                yield sentence
+            if not chunk:
+                break
+
+
+def read_sentences(path, attribute=None, accept_text=None):
+    '''Yields the sentences of the Korp xml file at path, which may be
+    bzipped.'''
+    with open_corpus(path) as infile:
+        for sentence in KorpReader(infile, attribute,
+                                   accept_text=accept_text):
+            yield sentence
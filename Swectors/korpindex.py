@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import bisect
+import collections
+import json
+import os
+import xml.parsers.expat
+
+import bz2blocks
+import korp
+
+
+# The index of a file is written next to it, with this suffix
+INDEX_SUFFIX = '.index'
+END_TAG = b'</text>'
+
+
+class IndexedText(collections.namedtuple('IndexedText', ['start', 'end',
+                                                         'sentences',
+                                                         'attrs'])):
+    '''A <text> element of an indexed file. start and end are the byte
+    offsets of the element in the decompressed file, sentences is the
+    number of <sentence> elements in it and attrs the dictionary of its
+    attributes. Texts without sentences are never read, so their end is
+    their start.'''
+
+    __slots__ = ()
+
+
+class TextScanner(object):
+    '''Finds the <text> elements of a Korp xml file fed to it in pieces.
+    Only start and end tags are handled, so scanning is much faster than
+    reading the sentences.'''
+
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.texts = []
+        # The start, attributes and number of sentences of the current text
+        self.current = None
+
+    def start(self, tag, attrs):
+        if tag == 'text':
+            self.current = [self.parser.CurrentByteIndex, attrs, 0]
+        elif tag == 'sentence' and self.current:
+            self.current[2] += 1
+
+    def end(self, tag):
+        if tag == 'text' and self.current:
+            start, attrs, sentences = self.current
+            # An empty element, <text ... />, has no end tag of its own, so
+            # the end is only taken from the end tag of a text with sentences
+            end = start
+            if sentences:
+                end = self.parser.CurrentByteIndex + len(END_TAG)
+            self.texts.append(IndexedText(start, end, sentences, attrs))
+            self.current = None
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
+
+
+class Index(object):
+    '''The index of a bzipped Korp xml file: the (start, end) bit offsets
+    of its bz2 blocks from bz2blocks.find_blocks, the offset of each block
+    in the decompressed file, and an IndexedText for each <text> element.
+    With it, the texts that match a filter are read by decompressing only
+    the blocks they are in.'''
+
+    def __init__(self, path, blocks, offsets, texts):
+        self.path = path
+        self.blocks = blocks
+        self.offsets = offsets
+        self.texts = texts
+
+    @property
+    def sentences(self):
+        return sum(text.sentences for text in self.texts)
+
+    def select(self, accept_text=None):
+        '''Returns the texts with sentences whose attributes accept_text,
+        e.g. from korp.text_filter, accepts, in file order.'''
+        return [text for text in self.texts if text.sentences and
+                (accept_text == None or accept_text(text.attrs))]
+
+    def block_range(self, text):
+        '''Returns the numbers of the first block of a text and of the
+        block after its last one.'''
+        return (bisect.bisect_right(self.offsets, text.start) - 1,
+                bisect.bisect_right(self.offsets, text.end - 1))
+
+    def iter_blocks(self, numbers, workers=0, stats=None):
+        '''Yields the number and decompressed data of each of the given
+        blocks, in order. With workers above 1, they are decompressed by a
+        pool of processes as by bz2blocks.iter_blocks.'''
+        if workers > 1:
+            blocks = [self.blocks[n] for n in numbers]
+            data = bz2blocks.iter_blocks(self.path, workers, stats, blocks)
+            for n, block in zip(numbers, data):
+                yield n, block
+            return
+        for n in numbers:
+            block, seconds = bz2blocks.decompress_block(
+                (self.path,) + tuple(self.blocks[n]))
+            if stats:
+                stats.add('decompress', seconds, len(block))
+            yield n, block
+
+    def iter_texts(self, texts, workers=0, stats=None):
+        '''Yields the xml of each of the given texts, which must be in file
+        order. Each block is decompressed once, even if several texts are
+        in it.'''
+        numbers = sorted(set(n for text in texts
+                             for n in range(*self.block_range(text))))
+        blocks = self.iter_blocks(numbers, workers, stats)
+        current = collections.OrderedDict()
+        for text in texts:
+            first, last = self.block_range(text)
+            for n in list(current):
+                if n < first:
+                    del current[n]
+            while not current or next(reversed(current)) < last - 1:
+                n, block = next(blocks)
+                current[n] = block
+            data = b''.join(current[n] for n in range(first, last))
+            offset = self.offsets[first]
+            yield data[text.start - offset:text.end - offset]
+
+    def iter_xml(self, texts, workers=0, stats=None):
+        '''Yields a Korp xml document made up of the given texts, in
+        pieces, e.g. for bz2blocks.PipelineReader.'''
+        yield b'<corpus>'
+        for data in self.iter_texts(texts, workers, stats):
+            yield data
+        yield b'</corpus>'
+
+    def write(self):
+        '''Writes the index next to the file. The first line records the
+        size and modification time of the file, so that a stale index is
+        not used, along with the blocks. Each following line holds a
+        text.'''
+        info = os.stat(self.path)
+        with open(self.path + INDEX_SUFFIX, 'w', encoding='utf-8') as f:
+            header = {'size': info.st_size, 'mtime': info.st_mtime_ns,
+                      'blocks': [list(block) + [offset] for block, offset
+                                 in zip(self.blocks, self.offsets)]}
+            f.write(json.dumps(header) + '\n')
+            for text in self.texts:
+                f.write(json.dumps(list(text), ensure_ascii=False) + '\n')
+
+
+def build_index(path, workers=0):
+    '''Decompresses a bzipped Korp xml file block by block, scans it for
+    <text> elements and writes its index. Returns the Index.'''
+    blocks = bz2blocks.find_blocks(path)
+    index = Index(path, blocks, [], [])
+    scanner = TextScanner()
+    offset = 0
+    for _, block in index.iter_blocks(range(len(blocks)), workers):
+        index.offsets.append(offset)
+        offset += len(block)
+        scanner.feed(block)
+    scanner.feed(b'', True)
+    index.texts = scanner.texts
+    index.write()
+    return index
+
+
+def load_index(path):
+    '''Returns the Index of a bzipped Korp xml file, or None if it has no
+    index or the file has changed since it was indexed.'''
+    if not os.path.exists(path + INDEX_SUFFIX):
+        return None
+    info = os.stat(path)
+    with open(path + INDEX_SUFFIX, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if (header['size'], header['mtime']) != (info.st_size,
+                                                 info.st_mtime_ns):
+            return None
+        texts = [IndexedText(*json.loads(line)) for line in f]
+    blocks = [(start, end) for start, end, _ in header['blocks']]
+    offsets = [offset for _, _, offset in header['blocks']]
+    return Index(path, blocks, offsets, texts)
+
+
+def read_sentences(path, attribute=None, accept_text=None, workers=0):
+    '''Yields the sentences of the texts of an indexed file that
+    accept_text accepts, like korp.read_sentences, but only decompresses
+    the blocks of those texts. Without an up-to-date index, the whole file
+    is read.'''
+    index = load_index(path)
+    if index == None:
+        for sentence in korp.read_sentences(path, attribute, accept_text):
+            yield sentence
+        return
+    texts = index.select(accept_text)
+    with bz2blocks.PipelineReader(index.iter_xml(texts, workers)) as infile:
+        for sentence in korp.KorpReader(infile, attribute):
+            yield sentence
+
+
+if __name__ == '__main__':
+    import bw_extract
+    parser = argparse.ArgumentParser(description="Indexes the texts of "
+                                     "bzipped Korp xml files, so that "
+                                     "bw_extract.py --index only reads the "
+                                     "texts that match its filters.")
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help="index files")
+    build_parser.add_argument('--workers', type=int, default=0,
+                              help="decompress the blocks of each file in "
+                              "this many processes")
+    query_parser = commands.add_parser('query', help="show how much of "
+                                       "each file a filter needs")
+    query_parser.add_argument('--genre', type=bw_extract.genre_list,
+                              default=['all'])
+    query_parser.add_argument('--year', type=bw_extract.year_list)
+    query_parser.add_argument('--filter', type=bw_extract.attribute_value,
+                              action='append', metavar='ATTRIBUTE=VALUE')
+    for command_parser in (build_parser, query_parser):
+        command_parser.add_argument('files', nargs='*', help="xml.bz2 files; "
+                                    "by default all below the current "
+                                    "directory")
+    args = parser.parse_args()
+    if args.command == None:
+        parser.print_help()
+        parser.exit()
+    files = args.files or bw_extract.find_xmldocs(os.getcwd())
+    for path in files:
+        if args.command == 'build':
+            index = build_index(path, args.workers)
+            print("{file}: {texts} texts, {blocks} blocks".format(
+                file=path, texts=len(index.texts), blocks=len(index.blocks)))
+            continue
+        index = load_index(path)
+        if index == None:
+            print("{file}: no index, run build first".format(file=path))
+            continue
+        accept_text = korp.text_filter(bw_extract.text_conditions(args))
+        texts = index.select(accept_text)
+        blocks = set(n for text in texts
+                     for n in range(*index.block_range(text)))
+        print("{file}: {texts} of {total} texts, {sentences} sentences, "
+              "{blocks} of {all_blocks} blocks".format(
+                  file=path, texts=len(texts), total=len(index.texts),
+                  sentences=sum(text.sentences for text in texts),
+                  blocks=len(blocks), all_blocks=len(index.blocks)))
@@ -1,6 +1,99 @@
+import re
 import sys
+import argparse
 
-for line in sys.stdin:
-    words = [w for w in line.rstrip().lower().split() if w.isalpha() and w != 'noword']
-    if len(words) > 0:
-        print(" ".join(words))
+
+# The placeholder that bw_extract.py writes for words without text
+NOWORD = 'noword'
+# Numbers such as 2001, -3, 3,5 and 10:30 are folded into this token
+NUMBER_TOKEN = 'NUM'
+NUMBER_RE = re.compile(r'^[-+]?\d+(?:[.,:/]\d+)*%?$')
+
+
+def read_stopwords(path):
+    '''Reads a list of stopwords, one per line.'''
+    with open(path, encoding='utf-8') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+class Normalizer(object):
+    '''Normalizes the tokens of extracted sentences for training. The
+    filters are applied in this order: lowercasing, folding numbers into
+    NUMBER_TOKEN, keeping only alphabetical tokens, dropping tokens shorter
+    than min_length and dropping stopwords. The NOWORD placeholder is always
+    dropped. With the defaults, this is what postprocess.py has always done:
+    lowercase and keep alphabetical tokens.'''
+
+    def __init__(self, lowercase=True, alpha_only=True, min_length=1,
+                 stopwords=None, fold_numbers=False):
+        self.lowercase = lowercase
+        self.alpha_only = alpha_only
+        self.min_length = min_length
+        self.stopwords = stopwords or set()
+        self.fold_numbers = fold_numbers
+
+    def __call__(self, words):
+        '''Returns the normalized list of tokens for a list of tokens.'''
+        if self.lowercase:
+            words = [w.lower() for w in words]
+        if self.fold_numbers:
+            words = [NUMBER_TOKEN if NUMBER_RE.match(w) else w for w in words]
+        if self.alpha_only:
+            words = [w for w in words if w.isalpha()]
+        if self.min_length > 1:
+            words = [w for w in words if len(w) >= self.min_length]
+        if self.stopwords:
+            words = [w for w in words if w not in self.stopwords]
+        return [w for w in words if w != NOWORD]
+
+    def line(self, line):
+        '''Normalizes a line of whitespace-separated tokens. Returns the
+        normalized line without a newline, or None if no tokens are left.'''
+        words = self(line.split())
+        if words:
+            return ' '.join(words)
+        return None
+
+
+def add_arguments(parser):
+    '''Adds the options of the filters to an argparse parser.'''
+    parser.add_argument('--keep-case', action="store_true", default=False,
+                        help="do not lowercase")
+    parser.add_argument('--keep-nonalpha', action="store_true", default=False,
+                        help="keep tokens that are not alphabetical")
+    parser.add_argument('--min-length', type=int, default=1,
+                        help="drop tokens shorter than this")
+    parser.add_argument('--stopwords', metavar='FILE',
+                        help="drop the words in FILE, one per line")
+    parser.add_argument('--fold-numbers', action="store_true", default=False,
+                        help="replace numbers with " + NUMBER_TOKEN)
+
+
+def given_options(options):
+    '''Returns the options added by add_arguments that are not at their
+    defaults, e.g. ['--keep-case'].'''
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    return ['--' + name.replace('_', '-')
+            for name, value in sorted(vars(parser.parse_args([])).items())
+            if getattr(options, name) != value]
+
+
+def from_options(options):
+    '''Returns the Normalizer for the options added by add_arguments.'''
+    stopwords = read_stopwords(options.stopwords) if options.stopwords else None
+    return Normalizer(lowercase=not options.keep_case,
+                      alpha_only=not options.keep_nonalpha,
+                      min_length=options.min_length, stopwords=stopwords,
+                      fold_numbers=options.fold_numbers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Normalizes the output of "
+                                     "bw_extract.py from stdin to stdout.")
+    add_arguments(parser)
+    normalize = from_options(parser.parse_args())
+    for line in sys.stdin:
+        line = normalize.line(line)
+        if line != None:
+            sys.stdout.write(line + '\n')
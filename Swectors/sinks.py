@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''The output files of bw_extract.py, optionally compressed, which stay
+open for a whole extraction and are flushed at set intervals.'''
+
+import bz2
+import gzip
+import io
+import lzma
+import time
+
+
+COMPRESSORS = {'bz2': bz2.open, 'gzip': gzip.open, 'lzma': lzma.open}
+
+
+class Sink(object):
+    '''An output file that is kept open for the whole extraction, with a
+    large write buffer. The text is encoded the same way as by open(path,
+    "a+"), so the output is identical to writing each sentence with a
+    separate open call. If compression is given, it is one of the keys of
+    COMPRESSORS and the output is compressed on the fly, through a buffer
+    of the same size.
+
+    The buffer is flushed to the operating system whenever flush_bytes
+    characters have been written or flush_seconds seconds have passed
+    since the last flush, whichever comes first, so that a long extraction
+    can be followed and does not lose much if it crashes.'''
+
+    def __init__(self, path, compression=None, mode='a',
+                 buffer_size=1024*1024, flush_bytes=None, flush_seconds=None):
+        if compression:
+            if compression not in COMPRESSORS:
+                raise ValueError("Unknown compression: %s" % compression)
+            # The text modes of the compressors have a small fixed buffer
+            compressed = COMPRESSORS[compression](path, mode + 'b')
+            self.f = io.TextIOWrapper(io.BufferedWriter(compressed,
+                                                        buffer_size))
+        else:
+            self.f = open(path, mode, buffering=buffer_size)
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.f.write(text)
+        self.pending += len(text)
+        if self.flush_bytes and self.pending >= self.flush_bytes:
+            self.flush()
+        elif (self.flush_seconds and
+              time.monotonic() - self.last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sink(path, options, mode='a'):
+    '''Opens a Sink for path using the compression, buffer size and flush
+    thresholds given on the command line of bw_extract.py.'''
+    return Sink(path, compression=options.compress, mode=mode,
+                buffer_size=options.buffer_size,
+                flush_bytes=options.flush_bytes,
+                flush_seconds=options.flush_seconds)
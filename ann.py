@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Approximate nearest-neighbour search for the word embedding models.
+
+An inverted file (IVF) index clusters the normalized vectors with spherical
+k-means and keeps, for each centroid, the list of rows assigned to it. A
+query is only compared with the rows in the n_probe lists whose centroids are
+closest to it, so a search touches a fraction of the vocabulary. More lists
+make each list shorter and more probes trade speed for recall.
+
+The index is built once per model and saved next to it:
+
+    python ann.py build swectors --lists 1024
+    python ann.py bench swectors --probes 1 4 16
+
+after which load_index("swectors", embeddings) can be passed as index= to
+embeddings.n_most_similar.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import embeddings
+
+
+INDEX_SUFFIX = '.ivf.npz'
+
+
+def normalized_rows(vectors, rows):
+    """Returns the given rows of a model as float32 unit vectors."""
+    block = np.asarray(vectors.matrix[rows], dtype=np.float32)
+    return block * vectors.inv_norms[rows, None]
+
+
+def assign(data, centroids, block_size=65536):
+    """Returns the number of the most similar centroid for each row of
+    data, which should be normalized."""
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = np.asarray(data[start:start+block_size], dtype=np.float32)
+        labels[start:start+block_size] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(data, n_clusters, iterations=10, seed=0):
+    """Clusters normalized vectors by cosine similarity. Returns the
+    normalized centroids. Empty clusters are re-seeded with random rows."""
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(data, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=n_clusters)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        used = counts > 0
+        sums[used] = np.add.reduceat(data[order], starts[used], axis=0)
+        lengths = np.linalg.norm(sums, axis=1)
+        empty = lengths == 0
+        sums[empty] = data[rng.choice(len(data), empty.sum(), replace=False)]
+        lengths[empty] = 1
+        centroids = (sums / lengths[:, None]).astype(np.float32)
+    return centroids
+
+
+class IVFIndex(object):
+    """An inverted file index over a model. The rows assigned to list i
+    are order[offsets[i]:offsets[i+1]]."""
+
+    def __init__(self, vectors, centroids, order, offsets, n_probe=8):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, vectors, n_lists=1024, sample_size=100000, iterations=10,
+              seed=0, n_probe=8):
+        """Trains the centroids on a random sample of at most sample_size
+        rows and assigns every row of the model to its closest centroid.
+        There are never more lists than rows in the sample."""
+        rng = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(len(vectors),
+                                    min(sample_size, len(vectors)),
+                                    replace=False))
+        n_lists = min(n_lists, len(sample))
+        centroids = spherical_kmeans(normalized_rows(vectors, sample),
+                                     n_lists, iterations, seed)
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), embeddings.NORM_BLOCK_SIZE):
+            rows = np.arange(start, min(start + embeddings.NORM_BLOCK_SIZE,
+                                        len(vectors)))
+            labels[rows] = assign(normalized_rows(vectors, rows), centroids)
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+        return cls(vectors, centroids, order, offsets, n_probe)
+
+    def save(self, prefix):
+        np.savez(prefix + INDEX_SUFFIX, centroids=self.centroids,
+                 order=self.order, offsets=self.offsets)
+
+    def candidates(self, query, n_probe):
+        """Returns the rows in the n_probe lists closest to a normalized
+        query."""
+        n_probe = min(n_probe, len(self.centroids))
+        scores = self.centroids @ query
+        lists = np.argpartition(-scores, n_probe - 1)[:n_probe]
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i+1]]
+                               for i in lists])
+
+    def nearest(self, queries, k, n_probe=None, subset=None):
+        """Approximate version of Embeddings.nearest, with the same return
+        value. Only the rows in the n_probe closest lists are scored, so
+        fewer than k neighbours may be found; missing entries get row -1 and
+        similarity -inf. If a Subset is given, candidates outside it are
+        dropped before scoring."""
+        if n_probe is None:
+            n_probe = self.n_probe
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        lengths = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(lengths > 0, lengths, 1)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            cands = np.sort(self.candidates(query, n_probe))
+            if subset is not None:
+                cands = cands[subset.mask[cands]]
+            scores = normalized_rows(self.vectors, cands) @ query
+            top, top_sims = embeddings.top_k(scores[None, :], k)
+            rows[i, :top.shape[1]] = cands[top[0]]
+            sims[i, :top.shape[1]] = top_sims[0]
+        return rows, sims
+
+
+def load_index(prefix, vectors, n_probe=8):
+    """Loads the index saved next to a model by IVFIndex.save. Raises
+    ValueError if it was built for a model with another number of rows."""
+    with np.load(prefix + INDEX_SUFFIX) as data:
+        if len(data['order']) != len(vectors):
+            raise ValueError("The index %s has %d rows but the model has %d"
+                             % (prefix + INDEX_SUFFIX, len(data['order']),
+                                len(vectors)))
+        return IVFIndex(vectors, data['centroids'], data['order'],
+                        data['offsets'], n_probe)
+
+
+def benchmark(vectors, index, probes, n_queries=1000, k=10, seed=0):
+    """Compares the index with exact search on n_queries random words from
+    the vocabulary. Returns a list of (n_probe, recall, seconds per query),
+    with n_probe None for exact search. Recall is the fraction of the exact
+    top k that the index also finds."""
+    rng = np.random.RandomState(seed)
+    queries = vectors.matrix[np.sort(rng.choice(len(vectors),
+                                                min(n_queries, len(vectors)),
+                                                replace=False))]
+    start = time.time()
+    exact, _ = vectors.nearest(queries, k)
+    results = [(None, 1.0, (time.time() - start) / len(queries))]
+    for n_probe in probes:
+        start = time.time()
+        approx, _ = index.nearest(queries, k, n_probe=n_probe)
+        elapsed = (time.time() - start) / len(queries)
+        hits = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approx))
+        results.append((n_probe, hits / exact.size, elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help="build and save the "
+                                       "index of a model")
+    build_parser.add_argument('prefix', help="prefix of a converted model")
+    build_parser.add_argument('--lists', type=int, default=1024,
+                              help="number of k-means centroids")
+    build_parser.add_argument('--sample', type=int, default=100000,
+                              help="number of rows to train k-means on")
+    build_parser.add_argument('--iterations', type=int, default=10)
+    build_parser.add_argument('--seed', type=int, default=0)
+    bench_parser = commands.add_parser('bench', help="compare recall and "
+                                       "speed with exact search")
+    bench_parser.add_argument('prefix', help="prefix of a converted model")
+    bench_parser.add_argument('--probes', type=int, nargs='+',
+                              default=[1, 2, 4, 8, 16, 32])
+    bench_parser.add_argument('--queries', type=int, default=1000)
+    bench_parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+    if args.command == 'build':
+        vectors = embeddings.load_embeddings(args.prefix)
+        start = time.time()
+        index = IVFIndex.build(vectors, args.lists, args.sample,
+                               args.iterations, args.seed)
+        index.save(args.prefix)
+        print("Built {lists} lists over {words} words in {secs:.1f} s"
+              .format(lists=len(index.centroids), words=len(vectors),
+                      secs=time.time() - start))
+    elif args.command == 'bench':
+        vectors = embeddings.load_embeddings(args.prefix)
+        index = load_index(args.prefix, vectors)
+        print("n_probe\trecall@{k}\tms/query".format(k=args.k))
+        for n_probe, recall, secs in benchmark(vectors, index, args.probes,
+                                               args.queries, args.k):
+            print("{probe}\t{recall:.3f}\t\t{ms:.2f}".format(
+                probe='exact' if n_probe is None else n_probe,
+                recall=recall, ms=secs * 1000))
+    else:
+        parser.print_help()
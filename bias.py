@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Bias measures for the word embedding models, in matrix form.
+
+The WEAT association of a word w with two attribute sets A and B is
+
+    s(w, A, B) = mean cos(w, a) - mean cos(w, b)
+
+Since the mean of cosines with w is the dot product of w's unit vector with
+the mean of the attribute unit vectors, one vector per attribute pair is
+enough: s(w) = unit(w) . (mean unit(a) - mean unit(b)). The engine keeps
+that vector per (model, attribute sets), so any number of target words is
+scored with a single matrix product.
+
+The significance of a test statistic comes from a permutation test over the
+partitions of X and Y together. The associations are computed once, and the
+partitions are evaluated as index gathers on that vector in blocks, which
+can be spread over a process pool.
+
+RIPA projects words onto a bias direction, the first principal component
+of the differences between paired attribute words (e.g. man - woman). The
+direction is computed once per (model, attribute pairs) and reused until
+clear_cache is called.
+
+The measures work the same on float16 and int8 models from
+embeddings.quantize, computing in float32. fidelity compares the results of
+such a model with those of the full-precision model it was made from.
+"""
+import collections
+import itertools
+import multiprocessing
+import weakref
+
+import numpy as np
+
+
+# Engines and bias directions cached per model, keyed on the attribute
+# word lists
+_weat_cache = weakref.WeakKeyDictionary()
+_direction_cache = weakref.WeakKeyDictionary()
+
+WEATResult = collections.namedtuple('WEATResult', ['statistic', 'effect_size',
+                                                   'p_value',
+                                                   'x_association',
+                                                   'y_association'])
+
+FidelityReport = collections.namedtuple('FidelityReport', [
+    'weat_deviation', 'effect_size_deviation', 'ripa_deviation',
+    'min_overlap', 'mean_overlap'])
+
+# Number of partitions evaluated per block in permutation tests. Fixed, so
+# that results do not depend on the number of workers
+PERMUTATION_BLOCK_SIZE = 2000
+# Tolerance when comparing permuted statistics with the observed one, since
+# the same partition summed in another order may differ in the last bits
+PERMUTATION_TOLERANCE = 1e-9
+
+
+def unit_rows(matrix):
+    """Returns a float32 copy of a matrix with its rows scaled to unit
+    length. Rows of zeros stay zero."""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    lengths = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(lengths > 0, lengths, 1)
+
+
+class WEAT(object):
+    """WEAT scores against a pair of attribute word lists, e.g. male and
+    female words. Positive associations indicate the first (male) set and
+    negative associations the second (female) set. The engine only holds a
+    weak proxy of the model, so that caching it in get_weat does not keep
+    the model alive; keep a reference to the model while using it."""
+
+    def __init__(self, vectors, male_words, female_words):
+        self.vectors = weakref.proxy(vectors)
+        self.male_words = list(male_words)
+        self.female_words = list(female_words)
+        self.male = unit_rows(vectors.vectors_for(self.male_words))
+        self.female = unit_rows(vectors.vectors_for(self.female_words))
+        self.direction = self.male.mean(axis=0) - self.female.mean(axis=0)
+
+    def association_vectors(self, target_vectors):
+        """Returns s(w) for each row of a matrix of target vectors."""
+        return unit_rows(target_vectors) @ self.direction
+
+    def association(self, words, oov='raise'):
+        """Returns s(w) for each of a list of words as an array. With
+        oov='skip' words that are not in the model are left out, so use
+        vectors.rows_for to see which words were scored."""
+        return self.association_vectors(self.vectors.vectors_for(words, oov))
+
+    def test(self, x_words, y_words, oov='raise', permutations=None, seed=0,
+             workers=1):
+        """Returns the WEAT test statistic, the sum of s(x) over X minus the
+        sum of s(y) over Y, and the effect size, the difference of the means
+        divided by the standard deviation of s over X and Y together. Unlike
+        test_statistics in WEAT_RIPA.ipynb, X and Y may differ in length.
+        If a number of permutations is given, the p-value of the statistic
+        is computed with permutation_test; otherwise it is None."""
+        x = self.association(x_words, oov)
+        y = self.association(y_words, oov)
+        return weat_result(x, y, permutations, seed, workers)
+
+
+def weat_result(x, y, permutations=None, seed=0, workers=1):
+    """Builds a WEATResult from the associations of the X and Y words."""
+    statistic = float(x.sum() - y.sum())
+    spread = np.concatenate([x, y]).std(ddof=1)
+    if spread > 0:
+        effect_size = float((x.mean() - y.mean()) / spread)
+    else:
+        effect_size = float('nan')
+    if permutations:
+        p_value = permutation_test(x, y, permutations, seed=seed,
+                                   workers=workers)
+    else:
+        p_value = None
+    return WEATResult(statistic, effect_size, p_value, x, y)
+
+
+def _count_random_block(args):
+    """Counts the random partitions in one block whose statistic is at
+    least the observed one. Each block has its own seed, derived from the
+    test seed and the block number."""
+    scores, n_x, threshold, seed, block, size = args
+    rng = np.random.default_rng([seed, block])
+    x_rows = np.argsort(rng.random((size, len(scores))), axis=1)[:, :n_x]
+    x_sums = scores[x_rows].sum(axis=1)
+    return int(np.count_nonzero(2 * x_sums - scores.sum() >= threshold))
+
+
+def n_choose_k(n, k):
+    """Returns the number of ways to choose k of n items."""
+    k = min(k, n - k)
+    if k < 0:
+        return 0
+    count = 1
+    for i in range(1, k + 1):
+        count = count * (n - k + i) // i
+    return count
+
+
+def unrank_combination(rank, n, k):
+    """Returns the combination of k of range(n) at position rank in the
+    order of itertools.combinations."""
+    combination = []
+    c = 0
+    for i in range(k):
+        # The number of combinations that have c in position i
+        while True:
+            count = n_choose_k(n - c - 1, k - i - 1)
+            if rank < count:
+                break
+            rank -= count
+            c += 1
+        combination.append(c)
+        c += 1
+    return combination
+
+
+def iter_combinations(first, n):
+    """Yields the combinations of range(n) from first on, in the order of
+    itertools.combinations."""
+    combination = list(first)
+    k = len(combination)
+    while True:
+        yield tuple(combination)
+        i = k - 1
+        while i >= 0 and combination[i] == n - k + i:
+            i -= 1
+        if i < 0:
+            return
+        combination[i] += 1
+        for j in range(i + 1, k):
+            combination[j] = combination[j-1] + 1
+
+
+def _count_exact_block(args):
+    """Counts the partitions in a slice of all partitions whose statistic
+    is at least the observed one. The slice starts at its own first
+    partition, so no block enumerates the partitions before it."""
+    scores, n_x, threshold, start, size = args
+    combinations = itertools.islice(
+        iter_combinations(unrank_combination(start, len(scores), n_x),
+                          len(scores)), size)
+    x_rows = np.array(list(combinations), dtype=np.int64).reshape(-1, n_x)
+    x_sums = scores[x_rows].sum(axis=1)
+    return int(np.count_nonzero(2 * x_sums - scores.sum() >= threshold))
+
+
+def permutation_test(x, y, permutations=10000, exact=None, seed=0,
+                     workers=1):
+    """Returns the one-sided p-value of the WEAT statistic of the
+    associations x and y: the probability that a random partition of X and Y
+    together into sets of the same sizes has a statistic at least as large.
+
+    In exact mode every partition is evaluated; by default this is done when
+    there are no more partitions than the requested number of permutations.
+    Otherwise, random partitions are drawn in blocks of
+    PERMUTATION_BLOCK_SIZE, each with its own seed, and the p-value is
+    (1 + hits) / (1 + permutations). The result only depends on the seed,
+    not on the number of workers."""
+    scores = np.concatenate([x, y]).astype(np.float64)
+    n_x = len(x)
+    observed = scores[:n_x].sum() - scores[n_x:].sum()
+    threshold = observed - PERMUTATION_TOLERANCE
+    total = n_choose_k(len(scores), n_x)
+    if exact is None:
+        exact = total <= permutations
+    if exact:
+        tasks = [(scores, n_x, threshold, start,
+                  min(PERMUTATION_BLOCK_SIZE, total - start))
+                 for start in range(0, total, PERMUTATION_BLOCK_SIZE)]
+        count_block = _count_exact_block
+    else:
+        tasks = [(scores, n_x, threshold, seed, block,
+                  min(PERMUTATION_BLOCK_SIZE, permutations - start))
+                 for block, start in enumerate(range(0, permutations,
+                                                     PERMUTATION_BLOCK_SIZE))]
+        count_block = _count_random_block
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            hits = sum(pool.imap_unordered(count_block, tasks))
+    else:
+        hits = sum(map(count_block, tasks))
+    if exact:
+        return hits / total
+    return (1 + hits) / (1 + permutations)
+
+
+def get_weat(vectors, male_words, female_words):
+    """Returns the WEAT engine for a model and a pair of attribute word
+    lists, creating it the first time and reusing it afterwards."""
+    engines = _weat_cache.setdefault(vectors, {})
+    key = (tuple(male_words), tuple(female_words))
+    if key not in engines:
+        engines[key] = WEAT(vectors, male_words, female_words)
+    return engines[key]
+
+
+def first_principal_component(vectors):
+    """Returns the first principal component of the rows of a small
+    matrix, like PCA(n_components=1), using an SVD of the centered rows."""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    centered = vectors - vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    return vt[0]
+
+
+class BiasDirection(object):
+    """The RIPA bias direction of a model for a list of attribute word
+    pairs. Positive RIPA values indicate association with the first (male)
+    words and negative values with the second (female) words."""
+
+    def __init__(self, vectors, male_words, female_words):
+        # A weak proxy, like WEAT.vectors
+        self.vectors = weakref.proxy(vectors)
+        self.male_words = list(male_words)
+        self.female_words = list(female_words)
+        diffs = (vectors.vectors_for(self.male_words).astype(np.float64)
+                 - vectors.vectors_for(self.female_words))
+        direction = first_principal_component(diffs)
+        # The sign of a principal component is arbitrary, so we point it
+        # from the female towards the male words
+        if (diffs @ direction).sum() < 0:
+            direction = -direction
+        self.direction = direction.astype(np.float32)
+
+    def ripa_vectors(self, target_vectors):
+        """Returns the RIPA value of each row of a matrix of vectors."""
+        return np.asarray(target_vectors, dtype=np.float32) @ self.direction
+
+    def ripa(self, words, oov='raise'):
+        """Returns the RIPA value of each of a list of words as an array,
+        with a single matrix-vector product."""
+        return self.ripa_vectors(self.vectors.vectors_for(words, oov))
+
+
+def get_bias_direction(vectors, male_words, female_words):
+    """Returns the bias direction for a model and a list of attribute word
+    pairs, computing it the first time and reusing it afterwards."""
+    directions = _direction_cache.setdefault(vectors, {})
+    key = (tuple(male_words), tuple(female_words))
+    if key not in directions:
+        directions[key] = BiasDirection(vectors, male_words, female_words)
+    return directions[key]
+
+
+def clear_cache(vectors=None):
+    """Forgets the cached WEAT engines and bias directions of a model, or
+    of all models, e.g. after changing the vectors of a model in place."""
+    for cache in (_weat_cache, _direction_cache):
+        if vectors is None:
+            cache.clear()
+        else:
+            cache.pop(vectors, None)
+
+
+def fidelity(full, quantized, male_words, female_words, target_words,
+             x_words=None, y_words=None, k=10, n_queries=1000, seed=0):
+    """Compares a quantized model with the full-precision model it was made
+    from. Returns a FidelityReport with the largest absolute differences of
+    the WEAT associations and the RIPA values of the target words, and of
+    the WEAT effect size of x_words and y_words if they are given (else
+    None). min_overlap and mean_overlap are the smallest and the mean share
+    of the k nearest neighbours that the two models agree on, for n_queries
+    random words. Raises ValueError if none of the target words are in the
+    full model."""
+    target_words = list(target_words)
+    if not any(word in full for word in target_words):
+        raise ValueError("None of the target words are in the model: %s"
+                         % ', '.join(target_words))
+    weats = [get_weat(m, male_words, female_words) for m in (full, quantized)]
+    full_assoc, quantized_assoc = [w.association(target_words, oov='skip')
+                                   for w in weats]
+    weat_deviation = float(np.abs(full_assoc - quantized_assoc).max())
+    effect_size_deviation = None
+    if x_words is not None and y_words is not None:
+        full_test, quantized_test = [w.test(x_words, y_words, oov='skip')
+                                     for w in weats]
+        effect_size_deviation = abs(full_test.effect_size
+                                    - quantized_test.effect_size)
+    full_ripa, quantized_ripa = [
+        get_bias_direction(m, male_words, female_words).ripa(target_words,
+                                                             oov='skip')
+        for m in (full, quantized)]
+    ripa_deviation = float(np.abs(full_ripa - quantized_ripa).max())
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(full), min(n_queries, len(full)),
+                              replace=False))
+    full_rows, _ = full.nearest(np.asarray(full.matrix[rows],
+                                           dtype=np.float32), k)
+    quantized_rows, _ = quantized.nearest(
+        np.asarray(quantized.matrix[rows], dtype=np.float32), k)
+    overlaps = np.array([len(np.intersect1d(a, b)) / a.size
+                         for a, b in zip(full_rows, quantized_rows)])
+    return FidelityReport(weat_deviation, effect_size_deviation,
+                          ripa_deviation, float(overlaps.min()),
+                          float(overlaps.mean()))
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pre-tokenized training corpora for create_vectors.py.
+
+MySentences in create_vectors.py reads and splits every line of the text
+files again on each training epoch, in a single Python thread. This module
+tokenizes the text files once into integer ids over a fixed vocabulary:
+
+    python corpus.py build sentences corpus --min-count 25
+
+The corpus directory then holds vocab.tsv, the words with their counts in
+id order, and one shard per text file: NNNNN.ids, the int32 ids of all
+tokens, and NNNNN.offsets, the int64 offsets at which the sentences start,
+followed by the total number of tokens. Words below the minimum count are
+left out, as Word2Vec would ignore them anyway, and so are empty sentences.
+
+IdCorpus(path) memory-maps the shards and yields the sentences as lists of
+words, looking up whole blocks of ids at a time. For gensim's corpus_file
+mode, which reads a single text file in each worker without going through
+Python, the corpus can also be written back as one file of filtered
+sentences:
+
+    python corpus.py export corpus corpus.txt
+
+The vocabulary can also be counted on its own, by a pool of processes that
+each count a part of the text files, and written as a frequency table in
+the same format as vocab.tsv:
+
+    python corpus.py count sentences vocab.tsv --workers 8
+
+With --sketch, a first pass adds the counts of each part to a count-min
+sketch of fixed size, and a second pass only counts the words that the
+sketch estimates to occur at least --min-count times. The sketch never
+underestimates, so no such word is lost, and the counts kept are exact,
+but the merged counts only hold the frequent words.
+"""
+import argparse
+import array
+import bz2
+import collections
+import gzip
+import hashlib
+import io
+import lzma
+import multiprocessing
+import os
+
+import numpy as np
+
+
+VOCAB_FILE = 'vocab.tsv'
+IDS_SUFFIX = '.ids'
+OFFSETS_SUFFIX = '.offsets'
+# Number of tokens buffered before they are written to a shard
+WRITE_BLOCK_SIZE = 1 << 20
+# Number of sentences whose words are looked up at a time when iterating
+SENTENCE_BLOCK_SIZE = 4096
+# Text files are counted in parts of about COUNT_CHUNK_SIZE bytes, read
+# READ_SIZE bytes at a time
+COUNT_CHUNK_SIZE = 16 << 20
+READ_SIZE = 1 << 20
+# The default count-min sketch has SKETCH_DEPTH rows of SKETCH_WIDTH
+# counters, 64 MB in all
+SKETCH_WIDTH = 1 << 21
+SKETCH_DEPTH = 4
+# Compressed text files, e.g. from bw_extract.py --compress, are read
+# through these
+OPENERS = {'.bz2': bz2.open, '.gz': gzip.open, '.xz': lzma.open}
+
+
+def text_files(dirname):
+    """Returns the paths of the files in a directory in a fixed order."""
+    return [os.path.join(dirname, name) for name in sorted(os.listdir(dirname))
+            if os.path.isfile(os.path.join(dirname, name))]
+
+
+def source_files(paths):
+    """Returns the text files in a list of files and directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(text_files(path))
+        else:
+            files.append(path)
+    return files
+
+
+def open_file(path, mode='rb', **kwargs):
+    """Opens a text file, decompressing it if its extension is in
+    OPENERS."""
+    opener = OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, mode, **kwargs)
+
+
+def read_lines(path):
+    """Yields the lines of a text file, decoded the same way as by
+    MySentences in create_vectors.py."""
+    with open_file(path, 'rt', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            yield line
+
+
+def count_words(paths):
+    """Returns a Counter of the whitespace-separated tokens in the files."""
+    counts = collections.Counter()
+    for path in paths:
+        for line in read_lines(path):
+            counts.update(line.split())
+    return counts
+
+
+def line_ranges(path, chunk_size=COUNT_CHUNK_SIZE):
+    """Splits a text file into (start, end) byte ranges of about chunk_size
+    bytes that start and end at line boundaries. Compressed files cannot be
+    split, so they are a single range (None, None)."""
+    if os.path.splitext(path)[1] in OPENERS:
+        return [(None, None)]
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as f:
+        for offset in range(chunk_size, size, chunk_size):
+            f.seek(offset - 1)
+            f.readline()
+            if starts[-1] < f.tell() < size:
+                starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def read_range(path, start=None, end=None):
+    """Yields the lines in a byte range of a text file given by
+    line_ranges, or all its lines if start is None, decoded like
+    read_lines."""
+    if start is None:
+        for line in read_lines(path):
+            yield line
+        return
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding='utf-8',
+                                 errors='ignore'):
+        yield line
+
+
+def count_range(path, start=None, end=None):
+    """Returns a Counter of the tokens in the byte range of a text file
+    given by line_ranges, and the number of lines in it. The range is read
+    in blocks of whole lines, which are split all at once."""
+    counts = collections.Counter()
+    lines = 0
+    remaining = end - start if start is not None else -1
+    with open_file(path) as f:
+        if start:
+            f.seek(start)
+        while remaining:
+            data = f.read(READ_SIZE if remaining < 0
+                          else min(READ_SIZE, remaining))
+            if not data:
+                break
+            if remaining > 0:
+                remaining -= len(data)
+            if remaining and not data.endswith(b'\n'):
+                tail = f.readline()
+                data += tail
+                if remaining > 0:
+                    remaining -= len(tail)
+            lines += data.count(b'\n') + (not data.endswith(b'\n'))
+            counts.update(data.decode('utf-8', errors='ignore').split())
+    return counts, lines
+
+
+def sketch_columns(words, width, depth):
+    """Returns the counter of each word in each row of a count-min sketch,
+    as an array of shape (depth, words). Row i uses the hash h1 + i * h2,
+    where h1 and h2 are two 64-bit hashes of the word."""
+    digests = b''.join(hashlib.blake2b(w.encode('utf-8'),
+                                       digest_size=16).digest()
+                       for w in words)
+    hashes = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+    rows = np.arange(depth, dtype=np.uint64)[:, None]
+    columns = (hashes[:, 0] + rows * (hashes[:, 1] | np.uint64(1)))
+    return (columns % np.uint64(width)).astype(np.int64)
+
+
+class CountMinSketch(object):
+    """A count-min sketch: depth rows of width counters. The count of a
+    word is added to one counter in each row, chosen by a hash of the word,
+    and its estimated count is the smallest of these counters. Collisions
+    only add to a counter, so the estimate is never below the true count.
+    The hashes do not depend on the process, so sketches of the same size
+    can be merged by adding their tables."""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, table=None):
+        if table is None:
+            table = np.zeros((depth, width), dtype=np.int64)
+        self.table = table
+        self.depth, self.width = table.shape
+
+    def columns(self, words):
+        return sketch_columns(words, self.width, self.depth)
+
+    def add_columns(self, columns, counts):
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], counts)
+
+    def add(self, counts):
+        """Adds a Counter of words to the sketch."""
+        self.add_columns(self.columns(list(counts)),
+                         np.fromiter(counts.values(), dtype=np.int64,
+                                     count=len(counts)))
+
+    def estimate(self, words):
+        """Returns the estimated counts of a list of words as an array."""
+        columns = self.columns(words)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+
+def sketch_range(task):
+    """Worker function for the first pass of count_words_parallel. Counts
+    the words of a range and returns their sketch columns and counts,
+    which are much smaller than a table to merge."""
+    path, start, end, width, depth = task
+    counts, lines = count_range(path, start, end)
+    return (sketch_columns(list(counts), width, depth),
+            np.fromiter(counts.values(), dtype=np.int64, count=len(counts)),
+            lines)
+
+
+# The merged sketch in the worker processes of the second pass
+_sketch = None
+_min_count = 1
+
+
+def init_sketch(table, min_count):
+    global _sketch, _min_count
+    if table is not None:
+        _sketch = CountMinSketch(table=table)
+    _min_count = min_count
+
+
+def count_task(task):
+    """Worker function for count_words_parallel. Counts the words of a
+    range. In the second pass of a sketch, only the words whose estimated
+    count is at least min_count are returned."""
+    path, start, end = task
+    counts, lines = count_range(path, start, end)
+    tokens = sum(counts.values())
+    if _sketch is not None and counts:
+        words = list(counts)
+        keep = _sketch.estimate(words) >= _min_count
+        counts = collections.Counter({w: counts[w] for w, k in
+                                      zip(words, keep) if k})
+    return counts, lines, tokens
+
+
+def count_words_parallel(paths, workers=None, min_count=1, sketch=None,
+                         chunk_size=COUNT_CHUNK_SIZE):
+    """Counts the tokens in a list of text files with a pool of workers.
+    The files are split by line_ranges, each worker counts a range at a
+    time and the counters of the ranges are merged as they come in.
+
+    If sketch, an empty CountMinSketch, is given, the ranges are first
+    added to it, and then only the words that it estimates to occur at
+    least min_count times are counted and merged. Returns a Counter of the
+    words with at least min_count occurrences, and the number of lines,
+    tokens and of words counted before min_count was applied."""
+    tasks = [(path, start, end) for path in paths
+             for start, end in line_ranges(path, chunk_size)]
+    if sketch is not None:
+        with multiprocessing.Pool(workers) as pool:
+            for columns, values, _ in pool.imap_unordered(
+                    sketch_range,
+                    [t + (sketch.width, sketch.depth) for t in tasks]):
+                sketch.add_columns(columns, values)
+        initargs = (sketch.table, min_count)
+    else:
+        initargs = (None, min_count)
+    counts = collections.Counter()
+    lines = tokens = 0
+    with multiprocessing.Pool(workers, initializer=init_sketch,
+                              initargs=initargs) as pool:
+        for part, part_lines, part_tokens in pool.imap_unordered(count_task,
+                                                                 tasks):
+            counts.update(part)
+            lines += part_lines
+            tokens += part_tokens
+    counted = len(counts)
+    if min_count > 1:
+        counts = collections.Counter({w: c for w, c in counts.items()
+                                      if c >= min_count})
+    return counts, lines, tokens, counted
+
+
+def make_vocabulary(counts, min_count=1):
+    """Returns the words with at least min_count occurrences, the most
+    frequent first and ties in alphabetical order."""
+    return sorted((w for w, c in counts.items() if c >= min_count),
+                  key=lambda w: (-counts[w], w))
+
+
+def write_frequencies(filename, words, counts):
+    """Writes a frequency table: each word and its count, separated by a
+    tab, one per line."""
+    with open(filename, 'w', encoding='utf-8') as f:
+        for word in words:
+            f.write('{word}\t{count}\n'.format(word=word, count=counts[word]))
+
+
+def read_frequencies(filename):
+    """Returns the words and counts of a frequency table, in order."""
+    words = []
+    counts = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            word, count = line.rstrip('\n').split('\t')
+            words.append(word)
+            counts.append(int(count))
+    return words, counts
+
+
+def write_vocabulary(path, words, counts):
+    write_frequencies(os.path.join(path, VOCAB_FILE), words, counts)
+
+
+def read_vocabulary(path):
+    """Returns the words and counts of a corpus, in id order."""
+    return read_frequencies(os.path.join(path, VOCAB_FILE))
+
+
+def write_shard(source, prefix, index):
+    """Converts the text file source into the shard files prefix.ids and
+    prefix.offsets, using the ids in index. Returns the number of
+    sentences and tokens written."""
+    ids = array.array('i')
+    offsets = array.array('q', [0])
+    total = 0
+    with open(prefix + IDS_SUFFIX, 'wb') as ids_file:
+        for line in read_lines(source):
+            sentence = [index[w] for w in line.split() if w in index]
+            if not sentence:
+                continue
+            ids.extend(sentence)
+            total += len(sentence)
+            offsets.append(total)
+            if len(ids) >= WRITE_BLOCK_SIZE:
+                ids.tofile(ids_file)
+                del ids[:]
+        ids.tofile(ids_file)
+    with open(prefix + OFFSETS_SUFFIX, 'wb') as offsets_file:
+        offsets.tofile(offsets_file)
+    return len(offsets) - 1, total
+
+
+def build_corpus(dirname, path, min_count=1, workers=1, frequencies=None):
+    """Tokenizes the text files in dirname into a corpus at path, with a
+    vocabulary of the words that occur at least min_count times. The words
+    are counted by count_words_parallel if workers is above 1, or taken
+    from a frequency table written by count if one is given. The shards
+    of an earlier corpus at path are removed, since IdCorpus reads every
+    shard in the directory."""
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith((IDS_SUFFIX, OFFSETS_SUFFIX)):
+            os.remove(os.path.join(path, name))
+    sources = text_files(dirname)
+    if frequencies:
+        counts = dict(zip(*read_frequencies(frequencies)))
+    elif workers > 1:
+        counts = count_words_parallel(sources, workers, min_count)[0]
+    else:
+        counts = count_words(sources)
+    words = make_vocabulary(counts, min_count)
+    write_vocabulary(path, words, counts)
+    index = {w: i for i, w in enumerate(words)}
+    for n, source in enumerate(sources):
+        prefix = os.path.join(path, '{n:05d}'.format(n=n))
+        sentences, tokens = write_shard(source, prefix, index)
+        print("{source}: {sentences} sentences, {tokens} tokens".format(
+            source=source, sentences=sentences, tokens=tokens))
+    return IdCorpus(path)
+
+
+class IdCorpus(object):
+    """A corpus built by build_corpus. Iterating over it yields each
+    sentence as a list of words, which is what gensim expects of a corpus.
+    The ids of SENTENCE_BLOCK_SIZE sentences are looked up with one numpy
+    gather, so little work is left for Python per sentence."""
+
+    def __init__(self, path):
+        self.path = path
+        self.words, self.counts = read_vocabulary(path)
+        self.shards = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(IDS_SUFFIX):
+                prefix = os.path.join(path, name[:-len(IDS_SUFFIX)])
+                self.shards.append((read_array(prefix + IDS_SUFFIX, np.int32),
+                                    read_array(prefix + OFFSETS_SUFFIX,
+                                               np.int64)))
+
+    def __len__(self):
+        """The number of sentences."""
+        return sum(len(offsets) - 1 for _, offsets in self.shards)
+
+    def total_words(self):
+        return sum(len(ids) for ids, _ in self.shards)
+
+    def word_freq(self):
+        """Returns a dictionary of the word counts, for gensim's
+        build_vocab_from_freq."""
+        return dict(zip(self.words, self.counts))
+
+    def __iter__(self):
+        vocab = np.array(self.words, dtype=object)
+        for ids, offsets in self.shards:
+            for start in range(0, len(offsets) - 1, SENTENCE_BLOCK_SIZE):
+                bounds = offsets[start:start+SENTENCE_BLOCK_SIZE+1]
+                tokens = vocab[ids[bounds[0]:bounds[-1]]].tolist()
+                bounds = (bounds - bounds[0]).tolist()
+                for a, b in zip(bounds[:-1], bounds[1:]):
+                    yield tokens[a:b]
+
+    def export(self, path):
+        """Writes the corpus as a text file with one sentence per line, for
+        gensim's corpus_file mode."""
+        with open(path, 'w', encoding='utf-8') as f:
+            for sentence in self:
+                f.write(' '.join(sentence) + '\n')
+
+
+def read_array(path, dtype):
+    """Memory-maps a shard file. Empty files cannot be mapped, so they are
+    read as empty arrays."""
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help="tokenize a directory "
+                                       "of text files into a corpus")
+    build_parser.add_argument('sentences', help="directory of text files "
+                              "with one sentence per line")
+    build_parser.add_argument('corpus', help="directory to write to")
+    build_parser.add_argument('--min-count', type=int, default=25,
+                              help="leave out words with fewer occurrences")
+    build_parser.add_argument('--workers', type=int, default=1,
+                              help="count the words in this many processes")
+    build_parser.add_argument('--vocab', help="take the counts from a "
+                              "frequency table written by count")
+    count_parser = commands.add_parser('count', help="count the words of "
+                                       "text files into a frequency table")
+    count_parser.add_argument('sources', nargs='+', help="text files or "
+                              "directories of them, optionally compressed")
+    count_parser.add_argument('output', help="frequency table to write")
+    count_parser.add_argument('--min-count', type=int, default=1,
+                              help="leave out words with fewer occurrences")
+    count_parser.add_argument('--workers', type=int,
+                              default=multiprocessing.cpu_count())
+    count_parser.add_argument('--sketch', action='store_true',
+                              help="prune rare words with a count-min sketch "
+                              "before merging the counts")
+    count_parser.add_argument('--sketch-width', type=int,
+                              default=SKETCH_WIDTH)
+    count_parser.add_argument('--sketch-depth', type=int,
+                              default=SKETCH_DEPTH)
+    export_parser = commands.add_parser('export', help="write a corpus as "
+                                        "one text file for corpus_file")
+    export_parser.add_argument('corpus')
+    export_parser.add_argument('output')
+    args = parser.parse_args()
+    if args.command == 'build':
+        corpus = build_corpus(args.sentences, args.corpus, args.min_count,
+                              args.workers, args.vocab)
+        print("{words} words in the vocabulary, {sentences} sentences, "
+              "{tokens} tokens".format(words=len(corpus.words),
+                                       sentences=len(corpus),
+                                       tokens=corpus.total_words()))
+    elif args.command == 'count':
+        sketch = None
+        if args.sketch:
+            sketch = CountMinSketch(args.sketch_width, args.sketch_depth)
+        counts, lines, tokens, counted = count_words_parallel(
+            source_files(args.sources), args.workers, args.min_count, sketch)
+        write_frequencies(args.output, make_vocabulary(counts), counts)
+        print("{lines} lines, {tokens} tokens, {counted} words counted, "
+              "{kept} words written".format(lines=lines, tokens=tokens,
+                                            counted=counted,
+                                            kept=len(counts)))
+    elif args.command == 'export':
+        IdCorpus(args.corpus).export(args.output)
+    else:
+        parser.print_help()
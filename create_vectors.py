@@ -2,10 +2,24 @@
 # -*- coding: utf-8 -*-
 # Author: Per Fallgren
 
+import argparse
 import codecs
 import gensim, logging
+import json
+import multiprocessing
 import os
-import sys
+import time
+
+import numpy as np
+
+import corpus
+import embeddings
+
+# The vocabulary of a sweep, the size of its corpus and the log of its runs,
+# in the working directory
+SWEEP_VOCAB = 'sweep-vocab.tsv'
+SWEEP_INFO = 'sweep-vocab.json'
+SWEEP_LOG = 'sweep.tsv'
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 class MySentences(object):
@@ -17,34 +31,165 @@ class MySentences(object):
             for line in codecs.open(self.dirname + '/' + fname, "r", encoding='utf-8', errors='ignore'):
                 yield line.split()
 
-def cbow(dim, win, it):
-    fname = 'cbow-' + str(dim) + '-iter' + str(it)+ '-win' + str(win) + '.txt'
-    sentences = MySentences("sentences")
-    current_model = gensim.models.Word2Vec(sentences,  sg=0, size=dim, window=win, min_count=25, workers=8, hs=0, iter=it)
-    f = open(fname, "w")
-    current_model.wv.save_word2vec_format(fname, fvocab=None, binary=False)
-    f.close()
+def train(sg, dim, win, it, corpus_dir=None, corpus_file=None):
+    # A corpus built by corpus.py is tokenized already, and with corpus_file
+    # each worker reads its own part of the file without a producer thread
+    if corpus_file:
+        return gensim.models.Word2Vec(corpus_file=corpus_file, sg=sg, size=dim, window=win, min_count=25, workers=8, hs=0, iter=it)
+    if corpus_dir:
+        sentences = corpus.IdCorpus(corpus_dir)
+    else:
+        sentences = MySentences("sentences")
+    return gensim.models.Word2Vec(sentences, sg=sg, size=dim, window=win, min_count=25, workers=8, hs=0, iter=it)
+
+def model_name(model, dim, win, it):
+    # The output files are named by this and the extension of each format
+    return model + '-' + str(dim) + '-iter' + str(it)+ '-win' + str(win)
 
-def sgns(dim, win, it):
-    fname = 'sgns-' + str(dim) + '-iter' + str(it)+ '-win' + str(win) + '.txt'
-    sentences = MySentences("sentences")
-    current_model = gensim.models.Word2Vec(sentences, sg=1, size=dim, window=win, min_count=25, workers=8, hs=0, iter=it)
-    f = open(fname, "w")
-    current_model.save_word2vec_format(fname, fvocab=None, binary=False)
-    f.close()
+def export(current_model, fname, formats=('txt',), normalize=False, float16=False):
+    # The vectors are written one row at a time, so no normalized or
+    # converted copy of the whole matrix is made at the end of training
+    wv = current_model.wv
+    dtype = np.float16 if float16 else np.float32
+    with embeddings.ModelWriter(fname, len(wv.index2word), wv.vector_size, formats, normalize, dtype) as writer:
+        for i, word in enumerate(wv.index2word):
+            writer.write(word, wv.vectors[i])
 
+def cbow(dim, win, it, corpus_dir=None, corpus_file=None, formats=('txt',), normalize=False, float16=False):
+    fname = model_name('cbow', dim, win, it)
+    current_model = train(0, dim, win, it, corpus_dir, corpus_file)
+    export(current_model, fname, formats, normalize, float16)
 
-if __name__ == "__main__":
-    if sys.argv[1] == "cbow":
-        cbow(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
-    elif sys.argv[1] == "sgns":
-        sgns(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+def sgns(dim, win, it, corpus_dir=None, corpus_file=None, formats=('txt',), normalize=False, float16=False):
+    fname = model_name('sgns', dim, win, it)
+    current_model = train(1, dim, win, it, corpus_dir, corpus_file)
+    export(current_model, fname, formats, normalize, float16)
+
+def scan_vocabulary(corpus_file=None, workers=1):
+    # Counts the words of the training text in a pool of processes, like
+    # corpus.py count. Returns the counts of the words with at least 25
+    # occurrences and the numbers of sentences and words
+    paths = [corpus_file] if corpus_file else corpus.text_files("sentences")
+    counts, n_sentences, n_words, _ = corpus.count_words_parallel(paths, workers, min_count=25)
+    return counts, n_sentences, n_words
+
+def save_vocabulary(source, counts, n_sentences, n_words):
+    # The counts are written as a frequency table like that of corpus.py
+    # count, so it can also be given to corpus.py build --vocab, and the
+    # source and size of the corpus next to it
+    corpus.write_frequencies(SWEEP_VOCAB, corpus.make_vocabulary(counts), counts)
+    with open(SWEEP_INFO, 'w') as f:
+        json.dump({'source': source, 'sentences': n_sentences, 'words': n_words}, f)
+
+def load_vocabulary(corpus_dir=None):
+    # Returns the word counts and the numbers of sentences and words of the
+    # training corpus. A corpus built by corpus.py has them already
+    if corpus_dir:
+        sentences = corpus.IdCorpus(corpus_dir)
+        return sentences.word_freq(), len(sentences), sentences.total_words()
+    words, counts = corpus.read_frequencies(SWEEP_VOCAB)
+    with open(SWEEP_INFO) as f:
+        info = json.load(f)
+    return dict(zip(words, counts)), info['sentences'], info['words']
+
+def saved_source():
+    if not os.path.exists(SWEEP_INFO):
+        return None
+    with open(SWEEP_INFO) as f:
+        return json.load(f)['source']
+
+def corpus_source(corpus_file=None):
+    # The text files with their sizes and modification times, so that the
+    # saved vocabulary is counted again when any of them changes
+    paths = [corpus_file] if corpus_file else corpus.text_files("sentences")
+    return [[os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns] for path in paths]
+
+def prepare_vocabulary(corpus_dir=None, corpus_file=None, workers=1):
+    # The text is only counted if there is no saved vocabulary for it
+    if corpus_dir:
+        return
+    source = corpus_source(corpus_file)
+    if os.path.exists(SWEEP_VOCAB) and saved_source() == source:
+        print("Reusing the vocabulary in " + SWEEP_VOCAB)
+        return
+    start = time.time()
+    counts, n_sentences, n_words = scan_vocabulary(corpus_file, workers)
+    save_vocabulary(source, counts, n_sentences, n_words)
+    print("Counted {sentences} sentences in {secs:.0f} s".format(sentences=n_sentences, secs=time.time() - start))
+
+def run_config(task):
+    # Trains and saves one model of a sweep on the saved vocabulary. Returns
+    # a row for the sweep log
+    model, dim, win, it, workers, corpus_dir, corpus_file, formats, normalize, float16 = task
+    start = time.time()
+    word_freq, n_sentences, n_words = load_vocabulary(corpus_dir)
+    current_model = gensim.models.Word2Vec(sg=int(model == 'sgns'), size=dim, window=win, min_count=25, workers=workers, hs=0, iter=it)
+    current_model.build_vocab_from_freq(word_freq, corpus_count=n_sentences)
+    train_start = time.time()
+    if corpus_file:
+        _, raw_words = current_model.train(corpus_file=corpus_file, total_words=n_words, epochs=it)
     else:
-    	print("First parameter should be 'cbow' or 'sgns'")
+        sentences = corpus.IdCorpus(corpus_dir) if corpus_dir else MySentences("sentences")
+        _, raw_words = current_model.train(sentences, total_examples=n_sentences, epochs=it)
+    train_secs = time.time() - train_start
+    # The model is written under another name first, so that a run that is
+    # interrupted while saving is not taken as done
+    fname = model_name(model, dim, win, it)
+    export(current_model, fname + '.part', formats, normalize, float16)
+    for part, path in zip(embeddings.export_paths(fname + '.part', formats), embeddings.export_paths(fname, formats)):
+        os.replace(part, path)
+    return [model, dim, win, it, workers, round(time.time() - start, 1), round(train_secs, 1), int(raw_words / train_secs) if train_secs else 0]
+
+def sweep(models, dims, wins, iters, cores=8, workers=8, corpus_dir=None, corpus_file=None, formats=('txt',), normalize=False, float16=False):
+    # Trains a model for every combination of the parameters, except those
+    # whose output already exists. The vocabulary is counted once, and as
+    # many runs as fit in the core budget are trained at a time, each with
+    # its own gensim workers
+    configs = [(m, d, w, i) for m in models for d in dims for w in wins for i in iters]
+    todo = [c for c in configs if not all(os.path.exists(path) for path in embeddings.export_paths(model_name(*c), formats))]
+    print("{todo} of {total} configurations to train".format(todo=len(todo), total=len(configs)))
+    if not todo:
+        return
+    prepare_vocabulary(corpus_dir, corpus_file, cores)
+    workers = min(workers, cores)
+    tasks = [c + (workers, corpus_dir, corpus_file, formats, normalize, float16) for c in todo]
+    with open(SWEEP_LOG, 'a') as log:
+        if not log.tell():
+            log.write('model\tdim\twin\titer\tworkers\twall_secs\ttrain_secs\twords_per_sec\n')
+        with multiprocessing.Pool(max(1, cores // workers), maxtasksperchild=1) as pool:
+            for row in pool.imap_unordered(run_config, tasks):
+                print("Trained " + model_name(*row[:4]))
+                log.write('\t'.join(str(x) for x in row) + '\n')
+                log.flush()
 
 
-#  File "create_vectors.py", line 25, in cbow
-#    current_model.save_word2vec_format(fname, fvocab=None, binary=False)
-#  File "C:\Users\Rebecca\Documents\text-mining-project\env\lib\site-packages\gensim\models\word2vec.py", line 1307, in save_word2vec_format
-#    raise DeprecationWarning("Deprecated. Use model.wv.save_word2vec_format instead.")
-#DeprecationWarning: Deprecated. Use model.wv.save_word2vec_format instead.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    for model in ['cbow', 'sgns']:
+        model_parser = commands.add_parser(model, help="train a single " + model + " model")
+        model_parser.add_argument('dim', type=int)
+        model_parser.add_argument('win', type=int)
+        model_parser.add_argument('iter', type=int)
+    sweep_parser = commands.add_parser('sweep', help="train a model for every combination of the given parameters")
+    sweep_parser.add_argument('--models', nargs='+', choices=['cbow', 'sgns'], default=['sgns'])
+    sweep_parser.add_argument('--dims', type=int, nargs='+', default=[300])
+    sweep_parser.add_argument('--wins', type=int, nargs='+', default=[5])
+    sweep_parser.add_argument('--iters', type=int, nargs='+', default=[5])
+    sweep_parser.add_argument('--cores', type=int, default=multiprocessing.cpu_count(), help="total number of cores to use")
+    sweep_parser.add_argument('--workers', type=int, default=8, help="gensim workers per run")
+    for command_parser in commands.choices.values():
+        command_parser.add_argument('--corpus', help="train on a corpus built by corpus.py instead of the files in sentences/")
+        command_parser.add_argument('--corpus-file', help="train in gensim's corpus_file mode on a file written by corpus.py export")
+        command_parser.add_argument('--format', nargs='+', choices=embeddings.EXPORT_FORMATS, default=['txt'], help="word2vec text or binary, or the .npy and .vocab files of embeddings.py")
+        command_parser.add_argument('--normalize', action='store_true', help="scale the vectors to unit length")
+        command_parser.add_argument('--float16', action='store_true', help="store the .npy matrix as float16")
+    args = parser.parse_args()
+    if args.command == "cbow":
+        cbow(args.dim, args.win, args.iter, args.corpus, args.corpus_file, args.format, args.normalize, args.float16)
+    elif args.command == "sgns":
+        sgns(args.dim, args.win, args.iter, args.corpus, args.corpus_file, args.format, args.normalize, args.float16)
+    elif args.command == "sweep":
+        sweep(args.models, args.dims, args.wins, args.iters, args.cores, args.workers, args.corpus, args.corpus_file, args.format, args.normalize, args.float16)
+    else:
+        parser.print_help()
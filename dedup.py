@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Removes repeated sentences from text files with one sentence per line.
+
+Forum threads quote earlier posts, so the output of xml-to-text.py holds many
+copies of the same sentences, which slow down training and weigh the quoted
+sentences more than the rest. This keeps the first occurrence of each
+sentence, comparing the sentences with their whitespace normalized, and
+writes the files with the same names to another directory:
+
+    python dedup.py sentences sentences-dedup --workers 8
+
+With --minhash, sentences that are nearly the same as an earlier sentence
+are removed as well. Each sentence gets a MinHash signature of the word
+shingles in it, cut into bands of rows, and a sentence is removed if any of
+its bands equals the same band of an earlier sentence. With the default 16
+bands of 8 rows, a sentence whose shingles have a Jaccard similarity of 0.8
+with an earlier one is removed with probability 0.95, at 0.5 with
+probability 0.06.
+
+The files are split into ranges of lines by corpus.line_ranges, and the
+work is done in three passes by a pool of processes. First, each range is
+hashed into keys, one for each sentence and one for each band, which are
+split into shards by their value. Then each shard is deduplicated on its
+own, finding the keys that occur on an earlier line, so a worker only holds
+the keys of one shard. Finally the remaining lines of each range are
+written in order.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+import corpus
+
+
+# The default MinHash signatures have NUM_BANDS bands of BAND_ROWS rows, over
+# shingles of SHINGLE_SIZE words
+NUM_BANDS = 16
+BAND_ROWS = 8
+SHINGLE_SIZE = 2
+# Number of sentences whose signatures are computed at a time
+SIGNATURE_BLOCK_SIZE = 1024
+# The keys of a range: the key, the line it is on, and whether it is the key
+# of the whole sentence or of a band
+KEY_DTYPE = np.dtype([('key', '<u8'), ('line', '<i8'), ('exact', '?')])
+SEED = 1
+
+
+def sentence_key(words):
+    """Returns a 64-bit hash of a sentence given as a list of words."""
+    return int.from_bytes(hashlib.blake2b(' '.join(words).encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+def shingles(words, size=SHINGLE_SIZE):
+    """Returns the runs of size words in a sentence, or the whole sentence
+    if it is shorter."""
+    if len(words) <= size:
+        return [' '.join(words)]
+    return [' '.join(words[i:i+size]) for i in range(len(words) - size + 1)]
+
+
+class MinHasher(object):
+    """Computes the band keys of the MinHash signatures of sentences. Hash
+    function i maps the CRC-32 x of a shingle to the upper half of
+    a[i] * x + b[i] modulo 2**64, for fixed random a[i] and b[i]. The
+    signature of a sentence is the smallest value of each function over its
+    shingles, and the rows of each band are combined into one 64-bit key
+    that also depends on the number of the band."""
+
+    def __init__(self, bands=NUM_BANDS, rows=BAND_ROWS,
+                 shingle_size=SHINGLE_SIZE):
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(SEED)
+        n = bands * rows
+        self.a = rng.randint(0, 2**63, size=n, dtype=np.uint64) * 2 + 1
+        self.b = rng.randint(0, 2**63, size=n, dtype=np.uint64)
+        self.mix = rng.randint(0, 2**63, size=rows, dtype=np.uint64) * 2 + 1
+        self.band_ids = rng.randint(0, 2**63, size=bands, dtype=np.uint64)
+
+    def keys(self, sentences):
+        """Returns the band keys of a list of sentences, each a list of
+        words, as an array of shape (sentences, bands). The minimum of each
+        sentence is taken over its segment of all the hashed shingles."""
+        hashes = []
+        counts = []
+        for words in sentences:
+            parts = shingles(words, self.shingle_size)
+            counts.append(len(parts))
+            hashes.extend(zlib.crc32(part.encode('utf-8')) for part in parts)
+        x = np.array(hashes, dtype=np.uint64)[:, None]
+        values = (x * self.a + self.b) >> np.uint64(32)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        signatures = np.minimum.reduceat(values, starts, axis=0)
+        signatures = signatures.reshape(len(sentences), self.bands, self.rows)
+        return (signatures * self.mix).sum(axis=2) ^ self.band_ids
+
+
+def range_prefix(tmpdir, n):
+    return os.path.join(tmpdir, '{n:06d}'.format(n=n))
+
+
+def shard_prefix(tmpdir, shard):
+    return os.path.join(tmpdir, 'shard{shard:04d}'.format(shard=shard))
+
+
+def hash_range(task):
+    """Worker function for the first pass. Computes the keys of the lines
+    in a range and writes them sorted by shard, with the bounds of each
+    shard. Returns the number of lines."""
+    path, start, end, prefix, shards, minhasher = task
+    exact = []
+    bands = []
+    block = []
+    for line in corpus.read_range(path, start, end):
+        words = line.split()
+        exact.append(sentence_key(words))
+        if minhasher:
+            block.append(words)
+            if len(block) == SIGNATURE_BLOCK_SIZE:
+                bands.append(minhasher.keys(block))
+                block = []
+    if block:
+        bands.append(minhasher.keys(block))
+    lines = len(exact)
+    keys = np.zeros(lines, dtype=KEY_DTYPE)
+    keys['key'] = np.array(exact, dtype=np.uint64)
+    keys['line'] = np.arange(lines)
+    keys['exact'] = True
+    if bands:
+        bands = np.concatenate(bands)
+        band_keys = np.zeros(bands.size, dtype=KEY_DTYPE)
+        band_keys['key'] = bands.ravel()
+        band_keys['line'] = np.repeat(np.arange(lines), bands.shape[1])
+        keys = np.concatenate([keys, band_keys])
+    # A stable sort keeps the keys of each shard in line order
+    shard = keys['key'] % np.uint64(shards)
+    order = np.argsort(shard, kind='stable')
+    np.save(prefix + '.keys.npy', keys[order])
+    np.save(prefix + '.bounds.npy', np.searchsorted(shard[order],
+                                                    np.arange(shards + 1)))
+    return lines
+
+
+def dedup_shard(task):
+    """Worker function for the second pass. Gathers the keys of a shard
+    from all ranges, numbering their lines across the whole corpus, and
+    writes the lines that have a key that occurs on an earlier line, for
+    whole sentences and for bands."""
+    tmpdir, shard, bases = task
+    parts = []
+    for n, base in enumerate(bases[:-1]):
+        prefix = range_prefix(tmpdir, n)
+        bounds = np.load(prefix + '.bounds.npy')
+        keys = np.load(prefix + '.keys.npy', mmap_mode='r')
+        part = np.array(keys[bounds[shard]:bounds[shard+1]])
+        part['line'] += base
+        parts.append(part)
+    keys = np.concatenate(parts)
+    # The index returned is that of the first occurrence of each key
+    _, first = np.unique(keys['key'], return_index=True)
+    later = np.ones(len(keys), dtype=bool)
+    later[first] = False
+    dropped = keys[later]
+    prefix = shard_prefix(tmpdir, shard)
+    np.save(prefix + '.exact.npy', np.unique(dropped['line'][dropped['exact']]))
+    np.save(prefix + '.near.npy', np.unique(dropped['line'][~dropped['exact']]))
+
+
+def dropped_lines(tmpdir, shards, kind, base, count):
+    """Returns the lines of a kind dropped by any shard between base and
+    base + count, numbered from base."""
+    parts = []
+    for shard in range(shards):
+        lines = np.load(shard_prefix(tmpdir, shard) + '.' + kind + '.npy',
+                        mmap_mode='r')
+        parts.append(np.array(lines[np.searchsorted(lines, base):
+                                    np.searchsorted(lines, base + count)]))
+    return np.unique(np.concatenate(parts)) - base
+
+
+def filter_range(task):
+    """Worker function for the third pass. Writes the lines of a range that
+    are kept to prefix.txt, one at a time. Returns the numbers of bytes
+    read and written, before any compression, and of exact and near
+    duplicates that were removed."""
+    path, start, end, prefix, tmpdir, shards, base, count = task
+    exact = dropped_lines(tmpdir, shards, 'exact', base, count)
+    near = dropped_lines(tmpdir, shards, 'near', base, count)
+    drop = np.zeros(count, dtype=bool)
+    drop[exact] = True
+    drop[near] = True
+    bytes_in = bytes_out = 0
+    with open(prefix + '.txt', 'wb') as out:
+        for line, dropped in zip(corpus.read_range(path, start, end),
+                                 drop.tolist()):
+            data = line.encode('utf-8')
+            bytes_in += len(data)
+            if not dropped:
+                out.write(data)
+                bytes_out += len(data)
+    # An exact duplicate has the same bands as well
+    return (bytes_in, bytes_out, len(exact),
+            np.count_nonzero(drop) - len(exact))
+
+
+class DedupStats(object):
+    """The numbers of lines and bytes read and written by dedup_files. The
+    bytes are those of the text, before any compression."""
+
+    def __init__(self):
+        self.lines = 0
+        self.exact = 0
+        self.near = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def report(self):
+        removed = self.exact + self.near
+        return ("Removed {removed} of {lines} lines ({share:.1%}): {exact} "
+                "exact and {near} near duplicates. Kept {out:.1f} of "
+                "{inp:.1f} MB".format(
+                    removed=removed, lines=self.lines,
+                    share=removed / self.lines if self.lines else 0.0,
+                    exact=self.exact, near=self.near, out=self.bytes_out / 1e6,
+                    inp=self.bytes_in / 1e6))
+
+
+def dedup_files(paths, output, workers=None, shards=None, minhasher=None):
+    """Removes the repeated sentences of a list of text files, keeping the
+    first occurrence in the order of the list, and writes each file with
+    the same name to the directory output. If a MinHasher is given, near
+    duplicates are removed too. The keys are split into shards, by default
+    as many as there are workers, in a temporary directory below output.
+    Raises ValueError if two files have the same name or output would
+    overwrite one of them. Returns a DedupStats."""
+    targets = {}
+    sources = set(os.path.abspath(path) for path in paths)
+    for path in paths:
+        target = os.path.join(output, os.path.basename(path))
+        if target in targets:
+            raise ValueError("{first} and {second} would both be written to "
+                             "{target}".format(first=targets[target],
+                                               second=path, target=target))
+        if os.path.abspath(target) in sources:
+            raise ValueError("{target} would overwrite an input file".format(
+                target=target))
+        targets[target] = path
+    os.makedirs(output, exist_ok=True)
+    workers = workers or multiprocessing.cpu_count()
+    shards = shards or workers
+    tmpdir = tempfile.mkdtemp(prefix='dedup-', dir=output)
+    stats = DedupStats()
+    try:
+        ranges = [(path, start, end) for path in paths
+                  for start, end in corpus.line_ranges(path)]
+        with multiprocessing.Pool(workers) as pool:
+            counts = pool.map(hash_range, [
+                (path, start, end, range_prefix(tmpdir, n), shards, minhasher)
+                for n, (path, start, end) in enumerate(ranges)])
+            bases = np.concatenate([[0], np.cumsum(counts)]).tolist()
+            pool.map(dedup_shard, [(tmpdir, shard, bases)
+                                   for shard in range(shards)])
+            out = current = None
+            tasks = [(path, start, end, range_prefix(tmpdir, n), tmpdir,
+                      shards, bases[n], counts[n])
+                     for n, (path, start, end) in enumerate(ranges)]
+            for task, (bytes_in, bytes_out, exact, near) in zip(
+                    tasks, pool.imap(filter_range, tasks)):
+                path, prefix = task[0], task[3]
+                if path != current:
+                    if out:
+                        out.close()
+                    out = corpus.open_file(
+                        os.path.join(output, os.path.basename(path)), 'wb')
+                    current = path
+                # The kept lines are copied from the file of the range, so
+                # no more than a buffer of them is held at a time
+                with open(prefix + '.txt', 'rb') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(prefix + '.txt')
+                stats.exact += exact
+                stats.near += near
+                stats.bytes_in += bytes_in
+                stats.bytes_out += bytes_out
+            if out:
+                out.close()
+        stats.lines = sum(counts)
+    finally:
+        shutil.rmtree(tmpdir)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('sources', nargs='+', help="text files or "
+                        "directories of them, e.g. sentences")
+    parser.add_argument('output', help="directory to write the files to")
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--shards', type=int, help="split the keys into "
+                        "this many shards (default: one per worker); more "
+                        "shards use less memory per worker")
+    parser.add_argument('--minhash', action='store_true',
+                        help="also remove near duplicates")
+    parser.add_argument('--bands', type=int, default=NUM_BANDS)
+    parser.add_argument('--rows', type=int, default=BAND_ROWS)
+    parser.add_argument('--shingle-size', type=int, default=SHINGLE_SIZE,
+                        help="number of words in a shingle")
+    args = parser.parse_args()
+    minhasher = None
+    if args.minhash:
+        minhasher = MinHasher(args.bands, args.rows, args.shingle_size)
+    stats = dedup_files(corpus.source_files(args.sources), args.output,
+                        args.workers, args.shards, minhasher)
+    print(stats.report())
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Word embedding models: compact on-disk storage, lookups and neighbours.
+
+A model is stored as two files sharing a prefix:
+
+    <prefix>.npy    float32 matrix with one row per word (numpy .npy format)
+    <prefix>.vocab  the words, one per line, in the same order as the rows
+
+The matrix is memory-mapped when loaded, so opening a model takes well under
+a second and several notebooks or processes share the same pages. Models are
+converted once from the word2vec text or binary output, e.g.
+
+    python embeddings.py convert swectors.txt.bz2 swectors
+    python embeddings.py convert Swectors/gp-2001-2013.bin swectors
+
+Models can also be written as word2vec text or binary files, with the rows
+scaled to unit length, and the .npy matrix can be stored as float16:
+
+    python embeddings.py convert swectors.txt.bz2 swectors --format bin npy --normalize --float16
+
+To keep more models in memory at once, a converted model can be quantized
+to float16, or to int8 with one float32 scale per row, about a quarter of
+the size:
+
+    python embeddings.py quantize swectors swectors-int8 --int8
+
+Quantized models are loaded and searched like any other, computing in
+float32; bias.fidelity reports how far their results are from those of the
+full model.
+"""
+import argparse
+import bz2
+import gzip
+import io
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+MATRIX_SUFFIX = '.npy'
+VOCAB_SUFFIX = '.vocab'
+# The row scales of an int8 matrix
+SCALES_SUFFIX = '.scales.npy'
+TEXT_SUFFIX = '.txt'
+BINARY_SUFFIX = '.bin'
+# 'txt' and 'bin' are the word2vec text and binary formats, 'npy' the
+# memory-mappable format
+EXPORT_FORMATS = ('txt', 'bin', 'npy')
+# Number of rows read at a time when computing row lengths of a mapped matrix
+NORM_BLOCK_SIZE = 65536
+
+
+OOV_MODES = ('raise', 'skip', 'zero')
+
+
+class OOVError(KeyError):
+    """Raised when a word is not in the vocabulary of a model."""
+
+
+def quantize_rows(block):
+    """Quantizes the rows of a float32 matrix to int8. Returns the codes
+    and the scale of each row, chosen so that the largest absolute value of
+    the row becomes 127."""
+    scales = np.abs(block).max(axis=1) / 127
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    codes = np.rint(block / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+class QuantizedMatrix(object):
+    """A matrix stored as int8 codes with a float32 scale per row, as
+    written by ModelWriter with dtype int8. Row i is codes[i] * scales[i].
+    Indexing it returns float32 rows, so it can stand in for the matrix of
+    an Embeddings object; only the rows asked for are dequantized."""
+
+    dtype = np.dtype(np.int8)
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        codes = np.asarray(self.codes[index], dtype=np.float32)
+        scales = np.asarray(self.scales[index], dtype=np.float32)
+        if codes.ndim == 1:
+            return codes * scales
+        return codes * scales[:, None]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class Embeddings(object):
+    """A word embedding model: a list of words and a matrix whose rows are
+    the corresponding vectors. Words are looked up through a hashed
+    word-to-row index, so lookups take constant time regardless of the size
+    of the vocabulary."""
+
+    def __init__(self, words, matrix):
+        if len(words) != matrix.shape[0]:
+            raise ValueError("Got %d words but %d vectors"
+                             % (len(words), matrix.shape[0]))
+        self.words = words
+        self.matrix = matrix
+        self.index = {}
+        for i, word in enumerate(words):
+            # Keep the first row if a word occurs twice, like a scan would
+            self.index.setdefault(word, i)
+        self._inv_norms = None
+        self.subsets = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def row(self, word):
+        """Returns the row number of a word, raising OOVError if it is not
+        in the vocabulary."""
+        try:
+            return self.index[word]
+        except KeyError:
+            raise OOVError(word)
+
+    def vector(self, word):
+        """Returns the vector of a single word."""
+        return self.matrix[self.row(word)]
+
+    def rows_for(self, words, oov='raise'):
+        """Returns the row numbers of a list of words as an array, along
+        with the list of words that were found. Out-of-vocabulary words are
+        handled according to oov: 'raise' raises OOVError, 'skip' leaves them
+        out and 'zero' gives them the row number -1."""
+        if oov not in OOV_MODES:
+            raise ValueError("oov must be one of %s, not '%s'"
+                             % (', '.join(OOV_MODES), oov))
+        rows = []
+        found = []
+        for word in words:
+            i = self.index.get(word)
+            if i is None:
+                if oov == 'raise':
+                    raise OOVError(word)
+                if oov == 'skip':
+                    continue
+                i = -1
+            rows.append(i)
+            found.append(word)
+        return np.array(rows, dtype=np.int64), found
+
+    def vectors_for(self, words, oov='raise'):
+        """Returns the vectors of a list of words as a single array with
+        one row per word. With oov='skip' out-of-vocabulary words are left
+        out, and with oov='zero' they get a vector of zeros."""
+        rows, _ = self.rows_for(words, oov)
+        vectors = np.asarray(self.matrix[np.maximum(rows, 0)],
+                             dtype=np.float32)
+        if oov == 'zero':
+            vectors[rows < 0] = 0
+        return vectors
+
+    @property
+    def inv_norms(self):
+        """The inverse of the length of every row, computed once. Rows of
+        zeros get zero instead of infinity."""
+        if self._inv_norms is None:
+            norms = np.empty(len(self), dtype=np.float32)
+            for start in range(0, len(self), NORM_BLOCK_SIZE):
+                block = np.asarray(self.matrix[start:start+NORM_BLOCK_SIZE],
+                                   dtype=np.float32)
+                norms[start:start+NORM_BLOCK_SIZE] = np.linalg.norm(block,
+                                                                    axis=1)
+            with np.errstate(divide='ignore'):
+                self._inv_norms = np.where(norms > 0, 1 / norms, 0).astype(
+                    np.float32)
+        return self._inv_norms
+
+    def similarities(self, queries, rows=None):
+        """Returns the cosine similarity between each query vector and
+        every word in the vocabulary, or only the given rows, as an array of
+        shape (queries, words). Instead of normalizing a copy of the matrix,
+        the scores of the (possibly memory-mapped) matrix are scaled by the
+        inverse row lengths, so the whole vocabulary is scored with one
+        matrix product. A float16 or int8 matrix is converted to float32
+        NORM_BLOCK_SIZE rows at a time, so the products are accumulated in
+        float32 without a float32 copy of the whole matrix."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        lengths = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(lengths > 0, lengths, 1)
+        if rows is not None:
+            block = np.asarray(self.matrix[rows], dtype=np.float32)
+            return (queries @ block.T) * self.inv_norms[rows]
+        if self.matrix.dtype not in (np.float16, np.int8):
+            return (queries @ self.matrix.T) * self.inv_norms
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), NORM_BLOCK_SIZE):
+            block = np.asarray(self.matrix[start:start+NORM_BLOCK_SIZE],
+                               dtype=np.float32)
+            scores[:, start:start+NORM_BLOCK_SIZE] = queries @ block.T
+        return scores * self.inv_norms
+
+    def nearest(self, queries, k, block_size=64, subset=None):
+        """Finds the k words most similar to each query vector. Returns two
+        arrays of shape (queries, k): the row numbers of the neighbours and
+        their cosine similarities, in order of decreasing similarity. The
+        queries are scored block_size at a time to bound the size of the
+        score matrix. If a Subset is given, only its words are searched."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        # A small subset is scored by gathering its rows, a large one by
+        # scoring everything and masking out the rest
+        gather = subset is not None and len(subset) <= len(self) // 2
+        k = min(k, len(self) if subset is None else len(subset))
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        sims = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start+block_size]
+            if gather:
+                scores = self.similarities(block, subset.rows)
+            else:
+                scores = self.similarities(block)
+                if subset is not None:
+                    scores[:, ~subset.mask] = -np.inf
+            top_rows, top_sims = top_k(scores, k)
+            if gather:
+                top_rows = subset.rows[top_rows]
+            rows[start:start+block_size] = top_rows
+            sims[start:start+block_size] = top_sims
+        return rows, sims
+
+    def subset(self, words):
+        """Returns the Subset of the vocabulary made up of the given words.
+        Words that are not in the vocabulary are ignored."""
+        rows, _ = self.rows_for(words, oov='skip')
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows] = True
+        return Subset(self, mask)
+
+    def named_subset(self, name, path=None, column='Word'):
+        """Returns a subset that is cached on the model under a name, such
+        as 'adjectives'. The first time a name is used, the words are read
+        from the given column of the CSV file at path, e.g.
+        data/adjektiv.txt.bz2."""
+        if name not in self.subsets:
+            if path is None:
+                raise KeyError("No subset named '%s' has been loaded" % name)
+            self.subsets[name] = self.subset(read_word_list(path, column))
+        return self.subsets[name]
+
+
+class Subset(object):
+    """A subset of the vocabulary of a model, stored as a boolean mask over
+    its rows. Subsets of the same model can be combined with & and |, and
+    searching them never copies the model."""
+
+    def __init__(self, vectors, mask):
+        self.vectors = vectors
+        self.mask = mask
+        self._rows = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, word):
+        return word in self.vectors and self.mask[self.vectors.row(word)]
+
+    @property
+    def rows(self):
+        """The row numbers in the subset, in increasing order."""
+        if self._rows is None:
+            self._rows = np.flatnonzero(self.mask)
+        return self._rows
+
+    @property
+    def words(self):
+        return [self.vectors.words[i] for i in self.rows]
+
+    def _check(self, other):
+        if other.vectors is not self.vectors:
+            raise ValueError("Cannot combine subsets of different models")
+
+    def __and__(self, other):
+        self._check(other)
+        return Subset(self.vectors, self.mask & other.mask)
+
+    def __or__(self, other):
+        self._check(other)
+        return Subset(self.vectors, self.mask | other.mask)
+
+
+def read_word_list(path, column='Word'):
+    """Reads a column of words from a CSV file such as
+    data/adjektiv.txt.bz2. Compressed files are read based on their
+    extension."""
+    return pd.read_csv(path)[column].dropna().astype(str)
+
+
+def top_k(scores, k):
+    """Returns the column numbers and values of the k largest scores in
+    each row of a score matrix, sorted in decreasing order. Uses
+    argpartition, so only the k selected scores are sorted."""
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return (np.take_along_axis(part, order, axis=1),
+            np.take_along_axis(part_scores, order, axis=1))
+
+
+def similars_frame(vectors, rows, sims):
+    """Builds the result frame of n_most_similar: the word and its
+    similarity, indexed by row number like the old DataFrame results."""
+    return pd.DataFrame({'word': [vectors.words[i] for i in rows],
+                         'similarity': sims}, index=rows)
+
+
+def trim_missing(rows, sims):
+    """Drops the row -1 entries an approximate search uses when it finds
+    fewer neighbours than asked for."""
+    found = rows >= 0
+    return rows[found], sims[found]
+
+
+def n_most_similar(vectors, n, word, subset=None, index=None):
+    """Returns the n words most similar to word, plus the word itself, as
+    a DataFrame with a 'word' and a 'similarity' column sorted by decreasing
+    similarity. Replaces the version in word-embedding-bias.ipynb that
+    applied a Python function to every row. If a Subset is given, such as
+    vectors.named_subset('adjectives'), only its words are searched. If an
+    approximate index from ann.py is given, it is searched instead of the
+    whole vocabulary."""
+    searcher = vectors if index is None else index
+    rows, sims = searcher.nearest(vectors.vector(word), n + 1, subset=subset)
+    return similars_frame(vectors, *trim_missing(rows[0], sims[0]))
+
+
+def n_most_similar_many(vectors, n, words, oov='raise', subset=None,
+                        index=None):
+    """Like n_most_similar, but for many query words at once, which are
+    scored with matrix-matrix products. Returns a dict from each query word
+    to its DataFrame."""
+    _, found = vectors.rows_for(words, oov=oov if oov == 'raise' else 'skip')
+    searcher = vectors if index is None else index
+    rows, sims = searcher.nearest(vectors.vectors_for(found), n + 1,
+                                  subset=subset)
+    return {word: similars_frame(vectors, *trim_missing(rows[i], sims[i]))
+            for i, word in enumerate(found)}
+
+
+def open_source(path):
+    """Opens a model file for binary reading, decompressing .bz2, .gz and
+    .zip files on the fly. A zip archive must contain a single file."""
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        names = archive.namelist()
+        if len(names) != 1:
+            raise ValueError("Expected a single file in %s, found %d"
+                             % (path, len(names)))
+        return archive.open(names[0])
+    return open(path, 'rb')
+
+
+def read_header(source):
+    """Reads the 'count dim' header line of a word2vec file."""
+    count, dim = source.readline().split()
+    return int(count), int(dim)
+
+
+def iter_text_rows(source, dim):
+    """Yields (word, vector) pairs from a word2vec text file."""
+    # The C word2vec tool truncates long words at a byte limit, which can
+    # split a multi-byte character, so we do not decode strictly
+    for line in io.TextIOWrapper(source, encoding='utf-8', errors='replace'):
+        parts = line.rstrip().split(' ')
+        if len(parts) != dim + 1:
+            raise ValueError("Expected %d values for '%s', got %d"
+                             % (dim, parts[0], len(parts) - 1))
+        yield parts[0], np.asarray(parts[1:], dtype=np.float32)
+
+
+def iter_binary_rows(source, count, dim):
+    """Yields (word, vector) pairs from a word2vec binary file."""
+    nbytes = dim * np.dtype(np.float32).itemsize
+    for i in range(count):
+        word = bytearray()
+        while True:
+            ch = source.read(1)
+            if not ch:
+                raise ValueError("Unexpected end of file after %d words" % i)
+            if ch == b' ':
+                break
+            # Vectors may or may not be followed by a newline
+            if ch != b'\n':
+                word.extend(ch)
+        vector = np.frombuffer(source.read(nbytes), dtype=np.float32)
+        yield word.decode('utf-8', errors='replace'), vector
+
+
+def export_paths(prefix, formats, dtype=np.float32):
+    """Returns the paths of the files that ModelWriter writes for the given
+    formats and matrix type."""
+    paths = []
+    for fmt in formats:
+        if fmt == 'txt':
+            paths.append(prefix + TEXT_SUFFIX)
+        elif fmt == 'bin':
+            paths.append(prefix + BINARY_SUFFIX)
+        elif fmt == 'npy':
+            paths.extend([prefix + MATRIX_SUFFIX, prefix + VOCAB_SUFFIX])
+            if np.dtype(dtype) == np.int8:
+                paths.append(prefix + SCALES_SUFFIX)
+        else:
+            raise ValueError("format must be one of %s, not '%s'"
+                             % (', '.join(EXPORT_FORMATS), fmt))
+    return paths
+
+
+class ModelWriter(object):
+    """Writes a model of count words and dim dimensions one row at a time,
+    in any of the EXPORT_FORMATS, so a model can be written without a copy
+    of its matrix. If normalize is true, each row is scaled to unit length
+    as it is written. dtype is the type of the .npy matrix; float16 halves
+    its size, and int8 quantizes each row with quantize_rows, writing the
+    scales to a second file. The word2vec formats always hold float32
+    values."""
+
+    def __init__(self, prefix, count, dim, formats=('npy',), normalize=False,
+                 dtype=np.float32):
+        export_paths(prefix, formats)
+        self.count = count
+        self.dim = dim
+        self.normalize = normalize
+        self.n = 0
+        self.text = self.binary = self.matrix = self.vocab = None
+        self.scales = None
+        header = ('%d %d\n' % (count, dim)).encode('utf-8')
+        if 'txt' in formats:
+            self.text = open(prefix + TEXT_SUFFIX, 'wb')
+            self.text.write(header)
+        if 'bin' in formats:
+            self.binary = open(prefix + BINARY_SUFFIX, 'wb')
+            self.binary.write(header)
+        if 'npy' in formats:
+            self.matrix = np.lib.format.open_memmap(
+                prefix + MATRIX_SUFFIX, mode='w+', dtype=dtype,
+                shape=(count, dim))
+            self.vocab = open(prefix + VOCAB_SUFFIX, 'w', encoding='utf-8')
+            if np.dtype(dtype) == np.int8:
+                self.scales = np.lib.format.open_memmap(
+                    prefix + SCALES_SUFFIX, mode='w+', dtype=np.float32,
+                    shape=(count,))
+            elif os.path.exists(prefix + SCALES_SUFFIX):
+                # Left over from an int8 model written to the same prefix
+                os.remove(prefix + SCALES_SUFFIX)
+
+    def write(self, word, vector):
+        if self.n == self.count:
+            raise ValueError("Got more than %d rows" % self.count)
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.normalize:
+            length = np.linalg.norm(vector)
+            if length > 0:
+                vector = vector / length
+        if self.text:
+            # Nine significant digits are enough to read back the same
+            # float32 value
+            self.text.write((word + ' ' + ' '.join('%.9g' % x for x in
+                                                   vector.tolist())
+                             + '\n').encode('utf-8'))
+        if self.binary:
+            # Like the C word2vec tool, with a newline after each vector
+            self.binary.write(word.encode('utf-8') + b' ' + vector.tobytes()
+                              + b'\n')
+        if self.scales is not None:
+            codes, scales = quantize_rows(vector[None, :])
+            self.matrix[self.n] = codes[0]
+            self.scales[self.n] = scales[0]
+            self.vocab.write(word + '\n')
+        elif self.matrix is not None:
+            self.matrix[self.n] = vector
+            self.vocab.write(word + '\n')
+        self.n += 1
+
+    def close(self):
+        """Closes the output files. The number of rows written is in n."""
+        for f in (self.text, self.binary, self.vocab):
+            if f:
+                f.close()
+        for matrix in (self.matrix, self.scales):
+            if matrix is not None:
+                matrix.flush()
+        self.matrix = self.scales = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert(source_path, prefix, binary=None, formats=('npy',),
+            normalize=False, dtype=np.float32):
+    """Converts a word2vec text or binary model into the memory-mappable
+    format, or any of the EXPORT_FORMATS. The rows are streamed straight
+    into the output files, so the conversion never holds more than one
+    vector in memory. If binary is None, files ending in .bin are read as
+    binary and all others as text. Raises ValueError if one of the output
+    files is the source, which would be truncated before it is read."""
+    source = os.path.abspath(source_path)
+    for path in export_paths(prefix, formats, dtype):
+        if os.path.abspath(path) == source:
+            raise ValueError("Cannot write %s over the model it is converted "
+                             "from" % path)
+    if binary is None:
+        binary = source_path.endswith('.bin')
+    with open_source(source_path) as source:
+        count, dim = read_header(source)
+        if binary:
+            rows = iter_binary_rows(source, count, dim)
+        else:
+            rows = iter_text_rows(source, dim)
+        with ModelWriter(prefix, count, dim, formats, normalize,
+                         dtype) as writer:
+            for word, vector in rows:
+                if writer.n == count:
+                    raise ValueError("%s has more rows than its header says"
+                                     % source_path)
+                writer.write(word, vector)
+        n = writer.n
+    if n != count:
+        raise ValueError("%s has %d rows, but its header says %d"
+                         % (source_path, n, count))
+    return count, dim
+
+
+def save_embeddings(embeddings, prefix):
+    """Writes an Embeddings object in the memory-mappable format."""
+    np.save(prefix + MATRIX_SUFFIX, np.asarray(embeddings.matrix,
+                                               dtype=np.float32))
+    with open(prefix + VOCAB_SUFFIX, 'w', encoding='utf-8') as vocab:
+        for word in embeddings.words:
+            vocab.write(word + '\n')
+
+
+def quantize(source_prefix, prefix, dtype=np.int8):
+    """Writes a quantized copy of a model in the memory-mappable format,
+    with a float16 or int8 matrix. The rows are streamed from the
+    memory-mapped source, so it cannot be written over."""
+    if os.path.abspath(prefix) == os.path.abspath(source_prefix):
+        raise ValueError("Cannot quantize %s into itself" % prefix)
+    source = load_embeddings(source_prefix)
+    with ModelWriter(prefix, len(source), source.dim, ('npy',),
+                     dtype=dtype) as writer:
+        for start in range(0, len(source), NORM_BLOCK_SIZE):
+            block = np.asarray(source.matrix[start:start+NORM_BLOCK_SIZE],
+                               dtype=np.float32)
+            for word, vector in zip(source.words[start:start+NORM_BLOCK_SIZE],
+                                    block):
+                writer.write(word, vector)
+    return len(source), source.dim
+
+
+def load_embeddings(prefix, mmap=True):
+    """Loads a model written by convert or save_embeddings. By default the
+    matrix is memory-mapped read-only, so nothing but the vocabulary is read
+    up front and the pages are shared with other processes using the same
+    model. An int8 matrix is loaded as a QuantizedMatrix with its scales."""
+    matrix = np.load(prefix + MATRIX_SUFFIX, mmap_mode='r' if mmap else None)
+    if matrix.dtype == np.int8:
+        matrix = QuantizedMatrix(matrix, np.load(prefix + SCALES_SUFFIX,
+                                                 mmap_mode='r' if mmap
+                                                 else None))
+    with open(prefix + VOCAB_SUFFIX, encoding='utf-8') as vocab:
+        words = vocab.read().split('\n')[:-1]
+    return Embeddings(words, matrix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    convert_parser = commands.add_parser('convert', help="convert a word2vec "
+                                         "model to the memory-mappable format")
+    convert_parser.add_argument('source', help="word2vec text or binary "
+                                "model, optionally .bz2/.gz/.zip compressed")
+    convert_parser.add_argument('prefix', help="output prefix for the .npy "
+                                "and .vocab files")
+    convert_parser.add_argument('--binary', action='store_true', default=None,
+                                help="read the model as binary even if it "
+                                "does not end in .bin")
+    convert_parser.add_argument('--format', nargs='+', choices=EXPORT_FORMATS,
+                                default=['npy'], help="formats to write")
+    convert_parser.add_argument('--normalize', action='store_true',
+                                help="scale the vectors to unit length")
+    convert_parser.add_argument('--float16', action='store_true',
+                                help="store the .npy matrix as float16")
+    convert_parser.add_argument('--int8', action='store_true',
+                                help="store the .npy matrix as int8 with a "
+                                "scale per row")
+    quantize_parser = commands.add_parser('quantize', help="write a float16 "
+                                          "or int8 copy of a converted model")
+    quantize_parser.add_argument('source', help="prefix of the model")
+    quantize_parser.add_argument('prefix', help="output prefix")
+    quantize_parser.add_argument('--int8', action='store_true',
+                                 help="int8 with a scale per row instead of "
+                                 "float16")
+    args = parser.parse_args()
+    if args.command == 'convert':
+        dtype = np.float32
+        if args.int8:
+            dtype = np.int8
+        elif args.float16:
+            dtype = np.float16
+        count, dim = convert(args.source, args.prefix, args.binary,
+                             args.format, args.normalize, dtype)
+        print("Wrote {count} {dim}-dimensional vectors to {paths}"
+              .format(count=count, dim=dim,
+                      paths=', '.join(export_paths(args.prefix,
+                                                   args.format, dtype))))
+    elif args.command == 'quantize':
+        dtype = np.int8 if args.int8 else np.float16
+        count, dim = quantize(args.source, args.prefix, dtype)
+        print("Wrote {count} {dim}-dimensional vectors to {paths}"
+              .format(count=count, dim=dim,
+                      paths=', '.join(export_paths(args.prefix, ['npy'],
+                                                   dtype))))
+    else:
+        parser.print_help()
@@ -1,53 +1,191 @@
 # xml-to-text
 # Author: Rebecca Lindblom
+"""Converts Korp xml files to plain text with one sentence per line.
+
+Each input file is written to a file with the same name and the extension
+.txt, e.g.
+
+	python xml-to-text.py "../data/familjeliv/*.xml" "../data/flashback/*.xml" --workers 8
+
+Plain xml files are split into chunks of about --chunk-size megabytes that
+start at <sentence> tags, so even a single large file is converted by all
+workers. Bzipped files are split into runs of bz2 blocks holding about as
+much xml, and each worker decompresses its own blocks. The chunks are
+written in order, so the output is the same as when converting the file in
+one go.
+"""
+import argparse
+import collections
+import glob
+import io
+import multiprocessing
+import os
 import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Swectors'))
+import bz2blocks
+import korp
+
+SENTENCE_TAG_RE = re.compile(rb'<sentence[\s>]')
+SENTENCE_RE = re.compile(rb'<sentence[\s>].*?</sentence>', re.S)
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# A bz2 block holds at most about this much data before compression
+BZ2_BLOCK_SIZE = 900 * 1000
+# Number of blocks after its own that a bz2 chunk may read to finish its
+# last sentence
+FOLLOW_BLOCKS = 16
+
+def sentence_text(sentence):
+	# Words without text are left out
+	return ' '.join(word for word in sentence.words if word)
+
+def find_sentence(f, offset):
+	"""Returns the offset of the first <sentence> tag at or after offset, or
+	None if there is none."""
+	f.seek(offset)
+	data = b''
+	while True:
+		block = f.read(READ_SIZE)
+		data += block
+		match = SENTENCE_TAG_RE.search(data)
+		if match:
+			return offset + match.start()
+		if not block:
+			return None
+		# Keep the end in case a tag is split between two blocks
+		keep = min(len(data), 10)
+		offset += len(data) - keep
+		data = data[len(data) - keep:]
+
+def chunk_ranges(path, chunk_size=CHUNK_SIZE):
+	"""Returns the (start, end) byte ranges of the chunks of a plain xml
+	file. Every chunk but the last ends where the next one starts, and
+	every chunk starts at a <sentence> tag, so each sentence is in exactly
+	one chunk."""
+	size = os.path.getsize(path)
+	starts = []
+	with open(path, 'rb') as f:
+		for offset in range(0, size, chunk_size):
+			start = find_sentence(f, offset)
+			if start is not None and (not starts or start > starts[-1]):
+				starts.append(start)
+	return list(zip(starts, starts[1:] + [size]))
+
+def block_chunks(path, chunk_size=CHUNK_SIZE):
+	"""Returns the tasks of a bzipped file: runs of bz2 blocks from
+	bz2blocks.find_blocks holding about chunk_size bytes of xml, each with
+	the blocks that follow it."""
+	blocks = bz2blocks.find_blocks(path)
+	n = max(1, chunk_size // BZ2_BLOCK_SIZE)
+	return [(path, blocks[i:i+n], blocks[i+n:i+n+FOLLOW_BLOCKS])
+			for i in range(0, len(blocks), n)]
+
+def block_sentences(path, blocks, following):
+	"""Returns the xml of the sentences that start in the given blocks of a
+	bzipped file. Sentences before the first <sentence> tag belong to the
+	previous chunk, and the last sentence is finished from the following
+	blocks."""
+	data = b''.join(bz2blocks.decompress_block((path, start, end))[0]
+					for start, end in blocks)
+	size = len(data)
+	following = list(following)
+	while True:
+		# A tag may be split between the last block and the next one
+		if following:
+			start, end = following.pop(0)
+			data += bz2blocks.decompress_block((path, start, end))[0]
+		starts = [m.start() for m in SENTENCE_TAG_RE.finditer(data)
+				  if m.start() < size]
+		if not starts or data.find(b'</sentence>', starts[-1]) != -1:
+			break
+		if not following:
+			raise ValueError("A sentence near byte {offset} of {file} does "
+							 "not end".format(offset=size, file=path))
+	return b''.join(m.group() for m in SENTENCE_RE.finditer(data)
+					if m.start() < size)
+
+def convert_chunk(task):
+	"""Worker function. Converts one chunk of a plain xml file, given by
+	its byte range, or of a bzipped file, given by its blocks, and returns
+	the text."""
+	path, start, end = task
+	if path.endswith('.bz2'):
+		data = block_sentences(path, start, end)
+	else:
+		with open(path, 'rb') as f:
+			f.seek(start)
+			data = f.read(end - start)
+		data = b''.join(SENTENCE_RE.findall(data))
+	# The chunk is not a document of its own, so its sentences are wrapped
+	# in an element of their own
+	sentences = korp.KorpReader(io.BytesIO(b'<chunk>' + data + b'</chunk>'))
+	return ''.join(sentence_text(sentence) + '\n' for sentence in sentences)
+
+def output_path(path):
+	for ext in ('.xml.bz2', '.xml'):
+		if path.endswith(ext):
+			return path[:-len(ext)] + '.txt'
+	return path + '.txt'
+
+def make_tasks(paths, chunk_size):
+	tasks = []
+	for path in paths:
+		if path.endswith('.bz2'):
+			tasks.extend(block_chunks(path, chunk_size))
+		else:
+			tasks.extend((path, start, end) for start, end in chunk_ranges(path, chunk_size))
+	return tasks
+
+def convert_files(paths, workers=1, chunk_size=CHUNK_SIZE):
+	"""Converts each of paths to the file given by output_path. The chunks
+	are converted by a pool of worker processes, with at most twice as many
+	chunks in flight as there are workers, and written in order."""
+	tasks = make_tasks(paths, chunk_size)
+	outputs = {}
+	for path in paths:
+		outputs[path] = open(output_path(path), 'w', encoding='utf-8')
+	remaining = collections.Counter(task[0] for task in tasks)
+
+	def write(task, text):
+		path = task[0]
+		outputs[path].write(text)
+		remaining[path] -= 1
+		if not remaining[path]:
+			outputs.pop(path).close()
+			print("Converted {file}".format(file=path))
+
+	if workers > 1:
+		pending = collections.deque()
+		with multiprocessing.Pool(workers) as pool:
+			for task in tasks:
+				pending.append((task, pool.apply_async(convert_chunk, (task,))))
+				if len(pending) >= 2 * workers:
+					task, result = pending.popleft()
+					write(task, result.get())
+			while pending:
+				task, result = pending.popleft()
+				write(task, result.get())
+	else:
+		for task in tasks:
+			write(task, convert_chunk(task))
+	# Files without sentences
+	for path, f in outputs.items():
+		f.close()
+		print("Converted {file}".format(file=path))
 
-def xml_to_text(input_file, output_file):
-
-	start = '<sentence'
-	end = '</sentence>'
-	numbers = []
-	rf = open(input_file, 'r', encoding="utf-8")
-	wf = open(output_file, "a", encoding="utf-8")
-	print("both files opened")
-	started = False
-	# Read one line at a time
-	for line in rf:
-		# If there is an end in the line, the collected sentence should be processed.
-		if end in line:
-			started = False
-			# Find all raw words in sentence and add to a list
-			sentence_words = [re.findall(r'>.+<', content) for content in sentence]
-			sentence_words = [' '.join([word[1:-1] for word in words]) for words in sentence_words]
-
-			processed = ' '.join(sentence_words)
-			#processed = clean_sentence(' '.join(sentence_words))
-			try:
-				wf.write(processed + '\n')
-			except Exception as e:
-				print("Error: ", e)
-				print(processed)
-				raise e
-		# If we have started, the line should be appended to sentence. 
-		if started:
-			sentence.append(line)
-		# Reset sentence list and start over.
-		if start in line:
-			started = True
-			sentence = []
-
-	rf.close()
-	wf.close()
-	print("both files closed")
-
-
-
-# Files to read:
-#xml_to_text("../data/flashback/flashback-ekonomi.xml", "../data/flashback/flashback-ekonomi.txt")
-#xml_to_text("../data/flashback/flashback-hem.xml", "../data/flashback/flashback-hem.txt")
-#xml_to_text("../data/flashback/flashback-kultur.xml", "../data/flashback/flashback-kultur.txt")
-
-xml_to_text("../data/familjeliv/familjeliv-allmanna-ekonomi.xml", "../data/familjeliv/familjeliv-allmanna-ekonomi.txt")
-xml_to_text("../data/familjeliv/familjeliv-allmanna-fritid.xml", "../data/familjeliv/familjeliv-allmanna-fritid.txt")
-xml_to_text("../data/familjeliv/familjeliv-allmanna-hushem.xml", "../data/familjeliv/familjeliv-allmanna-hushem.txt")
-xml_to_text("../data/familjeliv/familjeliv-allmanna-noje.xml", "../data/familjeliv/familjeliv-allmanna-noje.txt")
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('inputs', nargs='+', help="xml or xml.bz2 files, or glob patterns for them")
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+	parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE // (1024 * 1024),
+						help="size of the chunks of plain xml files in megabytes")
+	args = parser.parse_args()
+	paths = []
+	for pattern in args.inputs:
+		matches = sorted(glob.glob(pattern))
+		if not matches:
+			print("No files match {pattern}".format(pattern=pattern))
+		paths.extend(path for path in matches if path not in paths)
+	convert_files(paths, args.workers, args.chunk_size * 1024 * 1024)